@@ -11,6 +11,7 @@ LangChain チェーンアーキテクチャ サンプル集
 """
 
 import asyncio
+import os
 from typing import Dict, List, Any
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
@@ -19,10 +20,12 @@ from langchain_core.runnables import RunnablePassthrough, RunnableLambda, Runnab
 from pydantic import BaseModel, Field
 
 # ===== 共通設定 =====
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+
 def get_llm(streaming: bool = False, temperature: float = 0.7):
     """LLMインスタンスを取得"""
     return ChatOpenAI(
-        openai_api_base="http://localhost:11434/v1",
+        openai_api_base=OLLAMA_BASE_URL,
         streaming=streaming,
         temperature=temperature,
         openai_api_key="EMPTY",
@@ -5,15 +5,18 @@ LangChain チェーン 実用例集
 """
 
 import asyncio
+import os
 from typing import Dict, List
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableParallel
 
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+
 def get_llm(streaming: bool = False):
     return ChatOpenAI(
-        openai_api_base="http://localhost:11434/v1",
+        openai_api_base=OLLAMA_BASE_URL,
         streaming=streaming,
         temperature=0.7,
         openai_api_key="EMPTY",
@@ -6,7 +6,9 @@ import os
 import sys
 import time
 import uuid
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from langchain_openai import ChatOpenAI
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain.agents import create_agent
@@ -14,44 +16,51 @@ from langgraph.store.memory import InMemoryStore
 from langchain_core.messages import HumanMessage
 import uvicorn
 
+# 共通ライブラリ（langchain_server/lib）
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import async_log
+import metrics
+import token_counter
+from tool_cache import ToolCache
+from async_log import write_log
+import session_store
+import mcp_pool
+from tool_dispatch import ToolDispatchMiddleware
+
 # 設定ファイル名のデフォルト値
 DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), 'app.json')
 
 # Global variables to store initialized components
 tools = None
 llm = None
-sys_message = None
 config = None
-begin_time = None
 client = None
+mcp_pools = None
+tool_cache = None
 agent = None
+token_limiter = None
+# 会話セッションの状態（チェックポインター）
+sessions = None
+close_checkpointer = None
+# 初期化が完了してリクエストを受け付けられるか
+ready = False
+# 初期化のバックグラウンドタスクと、失敗したときの例外
+init_task = None
+init_error = None
 
-app = FastAPI()
-
-def setup_logging(log_folder: str) -> None:
-    if not os.path.exists(log_folder):
-        os.makedirs(log_folder)
-    filename = os.path.join(log_folder, f'mcp_ex_text.{datetime.datetime.now().strftime("%Y%m%d-%H%M")}.log')
-    logging.basicConfig(
-        filename=filename,
-        level=logging.ERROR,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        encoding='utf-8'
-    )
-
-def write_log(text: str, color: str = '0'):
-    now = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-    msg = f'{now} \033[{color}m{text}\033[0m'
-    print(msg)
-    logging.info(text)
+# ストリーミング時、リクエスト受付から最初のチャンク（ツール呼び出し通知または回答）までの時間
+FIRST_CHUNK_LATENCY = metrics.REGISTRY.histogram(
+    'agent_stream_first_chunk_seconds', 'Time from request to the first streamed agent step or token.'
+)
 
 def print_message_by_step(step, color_cfg):
+    # create_agent のノード名は model、create_react_agent では agent
     if 'tools' in step:
-        for msg in step.get('tools').get('messages'):
+        for msg in (step.get('tools') or {}).get('messages', []):
             write_log(f'tool> {msg.content}', color=color_cfg['tool'])
-    elif 'agent' in step:
+    elif 'model' in step or 'agent' in step:
         text = ''
-        for msg in step['agent'].get('messages'):
+        for msg in (step.get('model') or step.get('agent') or {}).get('messages', []):
             if msg.content != '' and not msg.tool_calls:
                 text += msg.content
             for tool_call in msg.tool_calls:
@@ -67,61 +76,260 @@ def load_config(config_path: str) -> dict:
         return json.load(f)
 
 async def initialize_components():
-    global tools, llm, sys_message, config, begin_time, client, agent
-    
+    """初期化とウォームアップ（lifespan から起動するバックグラウンドタスク）"""
+    global ready, init_error
+
+    try:
+        await _initialize_components()
+        if config.get('warm_up', True):
+            await warm_up()
+    except Exception as e:
+        init_error = e
+        logging.exception('initialization failed')
+        return
+    ready = True
+    write_log(f'system> リクエストの受付を開始します', color=config['color']['system'])
+
+async def _initialize_components():
+    global tools, llm, config, client, mcp_pools, tool_cache, agent, token_limiter, sessions, close_checkpointer
+
     args = sys.argv
     config_path = args[1] if len(args) >= 2 else DEFAULT_CONFIG
     config = load_config(config_path)
-    setup_logging(config['log_folder'])
+    # 画面表示とファイル出力はバックグラウンドのスレッドで行う（log_* の設定）
+    async_log.setup_logging(config['log_folder'], config)
     os.environ['TEMP'] = config['report_folder']
-    begin_time = datetime.datetime.now()
     write_log(f'system> 開始します', color=config['color']['system'])
 
-    # MultiServerMCPClientを初期化
+    # クライアントごとのトークンレート制限（0 または未設定なら無効）
+    rate = config.get('token_rate_limit_per_minute', 0)
+    if rate:
+        token_limiter = token_counter.TokenRateLimiter(rate, config.get('token_rate_limit_burst'))
+    # トークン数を数えるエンコーダーは受付開始の前に取得しておく（初回はダウンロードが起きうる）
+    await token_counter.warm_up([config['agent_model']])
+
+    # MultiServerMCPClientを初期化し、MCPサーバーのセッションを起動しておく
     client = MultiServerMCPClient(config['mcp_servers'])
-    tools = await client.get_tools()
+    mcp_pools = mcp_pool.MCPPools(
+        client,
+        min_size=config.get('mcp_pool_min_size', 1),
+        max_size=config.get('mcp_pool_max_size', 4),
+        health_interval=config.get('mcp_pool_health_interval', 30)
+    )
+    await mcp_pools.start()
+    # 読み取り専用のツール（cacheable_tools）の結果はセッションごとにキャッシュする
+    tool_cache = ToolCache.from_config(config)
+    tools = tool_cache.wrap(await mcp_pools.get_tools())
     write_log(f'system> {len(tools)}個のツールをロードしました', color=config['color']['system'])
     for tool in tools:
         write_log(f'system> ツール: {tool.name} - {tool.description}', color=config['color']['system'])
+    write_log(f'system> {tool_cache.describe()}', color=config['color']['system'])
     write_log(f'system> agentを構築します', color=config['color']['system'])
     
     llm = ChatOpenAI(
         openai_api_base=config['openai_api_base'],
-        streaming=False,
         temperature=0,
         openai_api_key="EMPTY",
         model=config['agent_model']
     )
     
+    # 会話履歴はセッションごとにチェックポインターへ保存する（memory / sqlite）
+    checkpointer, close_checkpointer = await session_store.create_checkpointer(
+        config.get('session_store', 'memory'), config.get('session_db_path', 'sessions.db'))
+    sessions = session_store.SessionManager(
+        checkpointer,
+        max_sessions=config.get('session_max', 100),
+        ttl_seconds=config.get('session_ttl_seconds', 3600)
+    )
+    sessions.restore(await session_store.stored_threads(checkpointer))
+
     # 新しいAPIを使用してエージェントを作成
     system_prompt = "\n".join(config['system_prompts'])
     agent = create_agent(
         model=llm,
         tools=tools,
         system_prompt=system_prompt,
+        # 1ステップの複数のツール呼び出しは同時に実行する（ツールごとの上限・タイムアウト付き）
+        middleware=[ToolDispatchMiddleware.from_config(config)],
+        checkpointer=checkpointer,
         store=InMemoryStore()
     )
 
+async def warm_up():
+    """モデルをロードさせるため、起動時に短いリクエストを1回送る"""
+    start = time.perf_counter()
+    try:
+        await llm.ainvoke([HumanMessage(content='ping')], max_tokens=1)
+        write_log(f'system> ウォームアップ完了 ({time.perf_counter() - start:.2f}秒)', color=config['color']['system'])
+    except Exception as e:
+        # LLMが起動していなくてもサーバーは起動させる（最初のリクエストで再接続される）
+        write_log(f'system> ウォームアップに失敗しました: {e}', color=config['color']['system'])
+        logging.error(f'warm up failed: {e}')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 初期化はバックグラウンドで1回だけ実行する。lifespan で待つと初期化が終わるまで接続を受け付けないので、
+    # その間も /health/ready が 503 を返せるようにする
+    global init_task
+    init_task = asyncio.create_task(initialize_components())
+    yield
+    if not init_task.done():
+        init_task.cancel()
+        try:
+            await init_task
+        except asyncio.CancelledError:
+            pass
+    if mcp_pools is not None:
+        await mcp_pools.close()
+    if close_checkpointer is not None:
+        await close_checkpointer()
+    async_log.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+metrics.install(app)
+
+
+def require_ready():
+    """初期化が終わっていなければ 503 を返す（統計のオブジェクトも初期化中は None）"""
+    if init_error is not None:
+        raise HTTPException(status_code=503, detail=f"initialization failed: {init_error}")
+    if not ready:
+        raise HTTPException(status_code=503, detail="initializing", headers={"Retry-After": "5"})
+
+@app.get("/health/ready")
+async def health_ready():
+    require_ready()
+    return {"status": "ready", "tools": len(tools)}
+
+@app.get("/v1/mcp/stats")
+async def mcp_stats():
+    require_ready()
+    return mcp_pools.stats()
+
+@app.get("/v1/tools/cache/stats")
+async def tool_cache_stats():
+    require_ready()
+    return tool_cache.stats()
+
+@app.get("/v1/sessions/stats")
+async def session_stats():
+    require_ready()
+    return sessions.stats()
+
+def sse_event(data) -> str:
+    """SSEの1イベント分の文字列を作成"""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    return f"data: {data}\n\n"
+
+def make_chunk(completion_id: str, created: int, delta: dict, finish_reason=None) -> dict:
+    """OpenAI形式の chat.completion.chunk を作成"""
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": config['agent_model'],
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+async def session_inputs(thread_id: str, messages: list, run_config: dict) -> list:
+    """チェックポインターの履歴と照合して、エージェントに渡すメッセージを決める"""
+    state = await agent.aget_state(run_config)
+    history = state.values.get("messages", []) if state else []
+    if session_store.is_continuation(history, messages):
+        # 続きの会話: 新しいユーザー発話だけを送る（それまでの履歴はチェックポインターにある）
+        return session_store.to_messages(messages[-1:])
+    # 新しい会話、または履歴が一致しない（再生成・サーバー再起動など）場合は履歴ごと送り直す
+    if history:
+        await sessions.reset(thread_id)
+    return session_store.to_messages(messages)
+
+async def stream_agent(thread_id: str, messages: list, run_config: dict,
+                       client_key: str, begin_time: datetime.datetime):
+    """agent.astream のステップを chat.completion.chunk のSSEとして送出する
+
+    ツール呼び出しは呼び出した時点で通知し、回答はトークン単位で送る。
+    """
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
+    start = time.perf_counter()
+    first = True
+    parts = []
+    show_tools = config.get('stream_tool_notices', True)
+
+    yield sse_event(make_chunk(completion_id, created, {"role": "assistant"}))
+    async with sessions.use(thread_id):
+        inputs = await session_inputs(thread_id, messages, run_config)
+        async_log.logger.debug('session %s inputs %s', thread_id, inputs)
+        async with mcp_pools.scope():
+            with tool_cache.session(thread_id):
+                stream = agent.astream({"messages": inputs}, config=run_config, stream_mode=["updates", "messages"])
+                async for mode, data in stream:
+                    content = ''
+                    if mode == "messages":
+                        # LLMの出力トークン（ツールの結果は送らない）
+                        chunk, meta = data
+                        if meta.get('langgraph_node') == 'model' and isinstance(chunk.content, str):
+                            content = chunk.content
+                            parts.append(content)
+                    else:
+                        print_message_by_step(data, config['color'])
+                        if show_tools:
+                            for msg in (data.get('model') or {}).get('messages', []):
+                                for tool_call in getattr(msg, 'tool_calls', None) or []:
+                                    args = json.dumps(tool_call['args'], ensure_ascii=False)
+                                    content += f"[{tool_call['name']}] {args}\n"
+                    if not content:
+                        continue
+                    if first:
+                        FIRST_CHUNK_LATENCY.observe(time.perf_counter() - start)
+                        first = False
+                    yield sse_event(make_chunk(completion_id, created, {"content": content}))
+    yield sse_event(make_chunk(completion_id, created, {}, finish_reason="stop"))
+    yield sse_event("[DONE]")
+
+    end_time = datetime.datetime.now()
+    write_log(f'system> 切断します (所要時間:{end_time - begin_time})', color=config['color']['system'],
+              session=thread_id, elapsed=(end_time - begin_time).total_seconds())
+    if token_limiter is not None:
+        token_limiter.consume(client_key, token_counter.count_tokens(''.join(parts), config['agent_model']))
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
-    # 初期化されていない場合は初期化を実行
-    if tools is None or llm is None or sys_message is None:
-        await initialize_components()
-    
+    if init_error is not None:
+        raise HTTPException(status_code=503, detail=f"Server failed to initialize: {init_error}")
+    if not ready:
+        raise HTTPException(status_code=503, detail="Server is initializing", headers={"Retry-After": "5"})
+
+    begin_time = datetime.datetime.now()
     body = await request.json()
     messages = body.get("messages", [])
-    print('input messages:', messages)
-    # prompt = "\n".join([m["content"] for m in messages if m["role"] == "user"])
-    prompt = "\n".join([m["content"] for m in messages])
-    print('prompt', prompt)
+    async_log.logger.debug('input messages: %s', messages)
+    prompt_tokens = token_counter.count_messages(messages, config['agent_model'])
+    client_key = token_counter.client_id(request, config.get('trust_client_id_header', False))
+    if token_limiter is not None:
+        token_limiter.check(client_key, prompt_tokens)
 
-    print('HumanMessage', HumanMessage(content=prompt))
-    result = await agent.ainvoke({"messages": [HumanMessage(content=prompt)]})
+    thread_id = session_store.session_key(request, messages, client_key, config.get('session_headers'))
+    # LLM呼び出しとMCPツール呼び出しの所要時間はコールバックで計測する
+    run_config = {
+        "configurable": {"thread_id": thread_id},
+        "callbacks": [metrics.MetricsCallbackHandler()]
+    }
+    if body.get("stream", False):
+        return StreamingResponse(
+            stream_agent(thread_id, messages, run_config, client_key, begin_time),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
 
-    write_log(f'agent> {result}', color=config['color']['agent'])
-    end_time = datetime.datetime.now()
-    write_log(f'system> 切断します (所要時間:{end_time - begin_time})', color=config['color']['system'])
+    async with sessions.use(thread_id):
+        inputs = await session_inputs(thread_id, messages, run_config)
+        async_log.logger.debug('session %s inputs %s', thread_id, inputs)
+        # エージェントの実行中はMCPサーバーごとに1つのセッションを借りる
+        async with mcp_pools.scope():
+            with tool_cache.session(thread_id):
+                result = await agent.ainvoke({"messages": inputs}, config=run_config)
 
     # LangChainの返答から最後のAIメッセージを抽出
     if isinstance(result, dict) and "messages" in result:
@@ -135,6 +343,17 @@ async def chat_completions(request: Request):
         # 通常の文字列やAIMessage型の場合
         response_text = getattr(result, "content", str(result))
 
+    # 結果全体ではなく回答と件数だけを記録する
+    end_time = datetime.datetime.now()
+    write_log(f'agent> {response_text}', color=config['color']['agent'],
+              session=thread_id, messages=len(result.get('messages', [])) if isinstance(result, dict) else None)
+    write_log(f'system> 切断します (所要時間:{end_time - begin_time})', color=config['color']['system'],
+              session=thread_id, elapsed=(end_time - begin_time).total_seconds())
+
+    completion_tokens = token_counter.count_tokens(response_text, config['agent_model'])
+    if token_limiter is not None:
+        token_limiter.consume(client_key, completion_tokens)
+
     return {
         "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
         "object": "chat.completion",
@@ -150,11 +369,7 @@ async def chat_completions(request: Request):
                 "finish_reason": "stop"
             }
         ],
-        "usage": {
-            "prompt_tokens": len(prompt.split()),
-            "completion_tokens": len(response_text.split()),
-            "total_tokens": len(prompt.split()) + len(response_text.split())
-        }
+        "usage": token_counter.usage(prompt_tokens, completion_tokens)
     }
 
 @app.get("/v1/models")
@@ -166,7 +381,5 @@ async def list_models():
     }
 
 if __name__ == '__main__':
-    # アプリケーション起動時に初期化を実行
-    import asyncio
-    asyncio.run(initialize_components())
+    # 初期化は lifespan から起動するバックグラウンドタスクで実行される
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,162 @@
+"""
+会話セッションごとのエージェント状態管理
+
+LangGraph のチェックポインターに会話履歴（ツール呼び出しを含む）を保存し、
+クライアントから毎回送られてくる会話履歴のうち新しいユーザー発話だけをエージェントに渡します。
+
+- セッションID: ヘッダー（X-Session-Id など）、なければ接続元と最初の発話のハッシュ
+- 保存先: メモリ（InMemorySaver）またはローカルの SQLite（AsyncSqliteSaver）
+- 一定時間使われないセッション・上限を超えた古いセッションは削除する
+"""
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+
+DEFAULT_HEADERS = ['X-Session-Id', 'X-OpenWebUI-Chat-Id']
+
+
+async def create_checkpointer(store: str = 'memory', db_path: str = 'sessions.db'):
+    """チェックポインターと終了時に呼ぶ close 関数を返す"""
+    if store == 'memory':
+        saver = InMemorySaver()
+
+        async def close():
+            pass
+        return saver, close
+
+    if store == 'sqlite':
+        try:
+            import aiosqlite
+            from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        except ImportError as e:
+            raise RuntimeError('session_store=sqlite には langgraph-checkpoint-sqlite が必要です') from e
+        conn = await aiosqlite.connect(db_path)
+        saver = AsyncSqliteSaver(conn)
+        await saver.setup()
+        return saver, conn.close
+
+    raise ValueError(f'unknown session_store: {store}')
+
+
+async def stored_threads(checkpointer) -> List[str]:
+    """保存先に残っているセッションID（SQLite のみ。メモリは再起動で消える）"""
+    conn = getattr(checkpointer, 'conn', None)
+    if conn is None:
+        return []
+    async with conn.execute('SELECT DISTINCT thread_id FROM checkpoints') as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+
+def _content(message: dict) -> str:
+    content = message.get('content') or ''
+    if not isinstance(content, str):
+        content = ' '.join(p.get('text', '') for p in content if isinstance(p, dict))
+    return content
+
+
+def session_key(request, messages: List[dict], client: str, headers: Optional[List[str]] = None) -> str:
+    """セッションIDを決める（ヘッダー > 接続元と最初のユーザー発話のハッシュ）"""
+    for name in headers or DEFAULT_HEADERS:
+        value = request.headers.get(name)
+        if value:
+            return value
+    first = next((_content(m) for m in messages if m.get('role') == 'user'), '')
+    return 'h:' + hashlib.sha256(f'{client}\n{first}'.encode('utf-8')).hexdigest()[:24]
+
+
+def to_messages(messages: List[dict]) -> list:
+    """OpenAI形式の会話履歴を LangChain のメッセージに変換する
+
+    system はエージェント側のシステムプロンプトを使うため渡さない。
+    """
+    result = []
+    for m in messages:
+        if m.get('role') == 'user':
+            result.append(HumanMessage(content=_content(m)))
+        elif m.get('role') == 'assistant':
+            result.append(AIMessage(content=_content(m)))
+    return result
+
+
+def is_continuation(history: list, messages: List[dict]) -> bool:
+    """保存済みの履歴が、今回の会話履歴から最後のユーザー発話を除いたものと一致するか"""
+    if not messages or messages[-1].get('role') != 'user':
+        return False
+    stored = [m.content for m in history if getattr(m, 'type', None) == 'human']
+    sent = [_content(m) for m in messages if m.get('role') == 'user']
+    return bool(stored) and stored == sent[:-1]
+
+
+class _Session:
+    def __init__(self):
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
+class SessionManager:
+    """セッションの最終利用時刻を管理し、TTL切れ・上限超過のセッションを削除する"""
+
+    def __init__(self, checkpointer, max_sessions: int = 100, ttl_seconds: float = 3600):
+        self.checkpointer = checkpointer
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions: 'OrderedDict[str, _Session]' = OrderedDict()
+        self.evicted = 0
+
+    def restore(self, thread_ids: List[str]):
+        """再起動前から保存先に残っているセッションを管理対象に加える（TTL経過で削除される）"""
+        for thread_id in thread_ids:
+            self._sessions.setdefault(thread_id, _Session())
+
+    @asynccontextmanager
+    async def use(self, thread_id: str):
+        """セッションを確保する。同じセッションへのリクエストは順番に処理する"""
+        session = self._sessions.get(thread_id)
+        if session is None:
+            session = self._sessions[thread_id] = _Session()
+        self._sessions.move_to_end(thread_id)
+        session.last_used = time.monotonic()
+        await self._evict()
+        async with session.lock:
+            try:
+                yield
+            finally:
+                session.last_used = time.monotonic()
+
+    async def reset(self, thread_id: str):
+        """保存済みの状態を削除する（会話履歴が一致しない場合など）"""
+        await self.checkpointer.adelete_thread(thread_id)
+
+    async def _evict(self):
+        now = time.monotonic()
+        expired = [t for t, s in self._sessions.items()
+                   if now - s.last_used > self.ttl_seconds and not s.lock.locked()]
+        overflow = len(self._sessions) - len(expired) - self.max_sessions
+        if overflow > 0:
+            # 古い順（OrderedDict の先頭）から処理中でないものを削除する
+            for t, s in self._sessions.items():
+                if overflow <= 0:
+                    break
+                if t not in expired and not s.lock.locked():
+                    expired.append(t)
+                    overflow -= 1
+        for thread_id in expired:
+            if self._sessions.pop(thread_id, None) is None:
+                continue
+            await self.checkpointer.adelete_thread(thread_id)
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        return {
+            'sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'ttl_seconds': self.ttl_seconds,
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,133 @@
+"""
+1ステップで呼ばれた複数のツールの並列実行（create_agent のミドルウェア）
+
+モデルが1回の応答で複数のツール呼び出し（例: 項目3と4をOKに更新）を返すと、create_agent は
+それぞれを同じステップの別タスクとして同時に実行し、結果（ToolMessage）は呼び出しの順に履歴へ追加します。
+ここではその実行に次の制御を加えます。
+
+- ツールごとの同時実行数の上限（tool_max_concurrency / tool_concurrency）。プロセス全体で共有し、MCPサーバーを守る
+- 1回の呼び出しのタイムアウト（tool_timeout_seconds / tool_timeouts）。超えたらエラーの ToolMessage を返し、モデルに伝える
+- ステップごとの実時間とツールの所要時間の合計を記録する（並列にした効果の確認用）
+
+    dispatcher = ToolDispatchMiddleware.from_config(config)
+    agent = create_agent(model=llm, tools=tools, middleware=[dispatcher], ...)
+"""
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from langchain.agents.middleware import AgentMiddleware
+from langchain_core.messages import ToolMessage
+
+import metrics
+from async_log import write_log
+
+TOOL_WAIT = metrics.REGISTRY.histogram(
+    'agent_tool_queue_wait_seconds', 'Time a tool call waited for its per-tool concurrency slot.',
+)
+TOOL_TIMEOUTS = metrics.REGISTRY.counter('agent_tool_timeouts_total', 'Tool calls cancelled by the per-call timeout.')
+STEP_WALL = metrics.REGISTRY.histogram(
+    'agent_tool_step_seconds', 'Wall time of one agent step that ran one or more tool calls.',
+)
+STEP_TOOL_SUM = metrics.REGISTRY.histogram(
+    'agent_tool_step_tool_seconds', 'Sum of the tool call durations in one agent step.',
+)
+
+# 完了しなかったステップ（途中で切断された実行など）の記録を捨てるまでの秒数
+STEP_EXPIRE_SECONDS = 600
+
+
+class _Step:
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.done = 0
+        self.start = time.perf_counter()
+        self.tool_seconds = 0.0
+        self.names = []
+
+
+class ToolDispatchMiddleware(AgentMiddleware):
+    """ツールごとの同時実行数の上限・タイムアウトとステップの所要時間の記録"""
+
+    def __init__(self, max_concurrency: int = 4, concurrency: Optional[Dict[str, int]] = None,
+                 timeout_seconds: float = 60, timeouts: Optional[Dict[str, float]] = None,
+                 log_color: str = '0'):
+        super().__init__()
+        self.max_concurrency = max_concurrency
+        self.concurrency = concurrency or {}
+        self.timeout_seconds = timeout_seconds
+        self.timeouts = timeouts or {}
+        self.log_color = log_color
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._steps: Dict[str, _Step] = {}
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'ToolDispatchMiddleware':
+        return cls(
+            max_concurrency=config.get('tool_max_concurrency', 4),
+            concurrency=config.get('tool_concurrency', {}),
+            timeout_seconds=config.get('tool_timeout_seconds', 60),
+            timeouts=config.get('tool_timeouts', {}),
+            log_color=config.get('color', {}).get('system', '0'),
+        )
+
+    def _semaphore(self, name: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            semaphore = self._semaphores[name] = asyncio.Semaphore(self.concurrency.get(name, self.max_concurrency))
+        return semaphore
+
+    def _step(self, request) -> Optional[str]:
+        """呼び出し元のAIメッセージ（=ステップ）のIDを返し、初回なら記録を始める"""
+        messages = request.state.get('messages', []) if isinstance(request.state, dict) else []
+        if not messages or not getattr(messages[-1], 'tool_calls', None):
+            return None
+        message = messages[-1]
+        step_id = message.id or str(id(message))
+        if step_id not in self._steps:
+            now = time.perf_counter()
+            for key in [k for k, s in self._steps.items() if now - s.start > STEP_EXPIRE_SECONDS]:
+                del self._steps[key]
+            self._steps[step_id] = _Step(len(message.tool_calls))
+        return step_id
+
+    def _finish(self, step_id: Optional[str], name: str, seconds: float):
+        step = self._steps.get(step_id) if step_id is not None else None
+        if step is None:
+            return
+        step.done += 1
+        step.tool_seconds += seconds
+        step.names.append(name)
+        if step.done < step.expected:
+            return
+        del self._steps[step_id]
+        wall = time.perf_counter() - step.start
+        STEP_WALL.observe(wall)
+        STEP_TOOL_SUM.observe(step.tool_seconds)
+        if step.expected > 1:
+            write_log(f'system> ツール {step.expected}件を並列実行: 実時間 {wall:.2f}秒 / 合計 {step.tool_seconds:.2f}秒',
+                      color=self.log_color, tools=','.join(step.names), wall=round(wall, 4),
+                      tool_seconds=round(step.tool_seconds, 4))
+
+    async def awrap_tool_call(self, request, handler):
+        name = request.tool_call['name']
+        step_id = self._step(request)
+        timeout = self.timeouts.get(name, self.timeout_seconds)
+        queued = time.perf_counter()
+        seconds = 0.0
+        try:
+            async with self._semaphore(name):
+                start = time.perf_counter()
+                TOOL_WAIT.observe(start - queued, tool=name)
+                try:
+                    return await asyncio.wait_for(handler(request), timeout or None)
+                except asyncio.TimeoutError:
+                    TOOL_TIMEOUTS.inc(tool=name)
+                    return ToolMessage(
+                        content=f'ツール {name} が {timeout}秒以内に終わらなかったため中止しました。',
+                        tool_call_id=request.tool_call['id'], name=name, status='error')
+                finally:
+                    seconds = time.perf_counter() - start
+        finally:
+            self._finish(step_id, name, seconds)
@@ -1,49 +1,45 @@
+import argparse
 import asyncio
 import datetime
+import glob
 import json
-import logging
 import os
+import statistics
 import sys
+import time
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_openai import ChatOpenAI
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langgraph.prebuilt import create_react_agent
-from langchain_core.messages import SystemMessage
 from langgraph.store.memory import InMemoryStore
 
+# 共通ライブラリ（langchain_server/lib）
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import async_log
+import token_counter
+from async_log import write_log
+from mcp_pool import MCPPools
+from tool_cache import ToolCache
+from history_manager import HistoryManager
+
 # 設定ファイル名のデフォルト値
 DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), 'app.json')
 
-def setup_logging(log_folder: str) -> None:
-    if not os.path.exists(log_folder):
-        os.makedirs(log_folder)
-    filename = os.path.join(log_folder, f'mcp_ex_text.{datetime.datetime.now().strftime("%Y%m%d-%H%M")}.log')
-    logging.basicConfig(
-        filename=filename,
-        level=logging.ERROR,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        encoding='utf-8'
-    )
-
-def write_log(text: str, color: str = '0'):
-    now = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
-    msg = f'{now} \033[{color}m{text}\033[0m'
-    print(msg)
-    logging.info(text)
-
-def print_message_by_step(step, color_cfg):
+def print_message_by_step(step, color_cfg, label: str = ''):
     if 'tools' in step:
         for msg in step.get('tools').get('messages'):
-            write_log(f'tool> {msg.content}', color=color_cfg['tool'])
+            write_log(f'{label}tool> {msg.content}', color=color_cfg['tool'])
     elif 'agent' in step:
         text = ''
         for msg in step['agent'].get('messages'):
             if msg.content != '' and not msg.tool_calls:
                 text += msg.content
             for tool_call in msg.tool_calls:
-                write_log(f'system> [{tool_call['name']}] {tool_call['args']}', color=color_cfg['system'])
+                write_log(f'{label}system> [{tool_call['name']}] {tool_call['args']}', color=color_cfg['system'])
         text = text.strip()
         if text != '':
-            write_log(f'system> {text}', color=color_cfg['system'])
+            write_log(f'{label}system> {text}', color=color_cfg['system'])
         return text
     return ''
 
@@ -51,72 +47,205 @@ def load_config(config_path: str) -> dict:
     with open(config_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
+class RunStats(BaseCallbackHandler):
+    """シナリオ1回分のLLM呼び出し・ツール呼び出し・トークン数を数える"""
+
+    def __init__(self):
+        self.llm_calls = 0
+        self.tool_calls = 0
+        self.tool_errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_llm_end(self, response, **kwargs):
+        self.llm_calls += 1
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    self.prompt_tokens += usage.get('input_tokens', 0)
+                    self.completion_tokens += usage.get('output_tokens', 0)
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.tool_calls += 1
+
+    def on_tool_error(self, error, **kwargs):
+        self.tool_errors += 1
+
+async def create_components(config: dict, workers: int = 1):
+    """LLMクライアント・MCPセッションプール・ツールを作成する（バッチでは全シナリオで共有）"""
+    # LLMへの接続は1つのコネクションプールを共有する
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=workers * 2, max_keepalive_connections=workers),
+        timeout=httpx.Timeout(config.get('llm_timeout', 300), connect=5)
+    )
+    llm = ChatOpenAI(
+        openai_api_base=config['openai_api_base'],
+        streaming=False,
+        temperature=0,
+        openai_api_key="EMPTY",
+        model=config['agent_model'],
+        http_async_client=http_client
+    )
+
+    # 履歴のトークン数を数えるエンコーダーは並列実行の前に取得しておく（初回はダウンロードが起きうる）
+    await token_counter.warm_up([config['agent_model']])
+
+    # MCPサーバーは並列数だけ先に起動しておき、シナリオごとに借りる
+    client = MultiServerMCPClient(config['mcp_servers'])
+    pools = MCPPools(
+        client,
+        min_size=workers,
+        max_size=workers,
+        health_interval=config.get('mcp_pool_health_interval', 30)
+    )
+    await pools.start()
+    # 読み取り専用のツール（cacheable_tools）の結果はキャッシュする
+    tool_cache = ToolCache.from_config(config)
+    tools = tool_cache.wrap(await pools.get_tools())
+    write_log(f'system> {len(tools)}個のツールをロードしました', color=config['color']['system'])
+    for tool in tools:
+        write_log(f'system> ツール: {tool.name} - {tool.description}', color=config['color']['system'])
+    write_log(f'system> {tool_cache.describe()}', color=config['color']['system'])
+    return llm, http_client, pools, tool_cache, tools
+
+async def run_scenario(name: str, config: dict, llm, tools, pools, tool_cache, label: str = '') -> dict:
+    """input_texts を順にエージェントへ送り、所要時間・ツール呼び出し数・トークン数を返す"""
+    # 会話履歴は直近の往復と古い往復の要約で組み立て、トークン数の上限に収める
+    history = HistoryManager.from_config(llm, config)
+    agent = create_react_agent(llm, tools, prompt=history.prompt, store=InMemoryStore())
+    stats = RunStats()
+    turn_latency = []
+    start = time.perf_counter()
+    try:
+        async with pools.scope():
+            with tool_cache.session(name):
+                for input_text in config['input_texts']:
+                    write_log(f'{label}user> {input_text}', color=config['color']['user'])
+                    turn_start = time.perf_counter()
+                    last_msg = None
+                    history.add('user', input_text)
+                    messages = await history.build()
+                    write_log(f'{label}system> 履歴: {len(messages)}件 {history.prompt_tokens(messages)}トークン (要約済み {history.summarized}件)',
+                              color=config['color']['system'])
+                    async for step in agent.astream({'messages': messages}, config={'callbacks': [stats]}):
+                        last_msg = print_message_by_step(step, config['color'], label)
+                    if last_msg is not None:
+                        history.add('assistant', last_msg)
+                    turn_latency.append(round(time.perf_counter() - turn_start, 3))
+    finally:
+        await history.aclose()
+    return {
+        'scenario': name,
+        'turns': len(turn_latency),
+        'latency_seconds': round(time.perf_counter() - start, 3),
+        'turn_latency_seconds': turn_latency,
+        'llm_calls': stats.llm_calls,
+        'tool_calls': stats.tool_calls,
+        'tool_errors': stats.tool_errors,
+        'prompt_tokens': stats.prompt_tokens,
+        'completion_tokens': stats.completion_tokens,
+    }
+
+async def run_batch(config: dict, scenario_dir: str, workers: int, output: str, components) -> list:
+    """ディレクトリ内のシナリオJSONを workers 件ずつ並列に実行し、結果をJSONLで書き出す"""
+    llm, _, pools, tool_cache, tools = components
+    files = sorted(glob.glob(os.path.join(scenario_dir, '*.json')))
+    write_log(f'system> {len(files)}件のシナリオを {workers} 並列で実行します', color=config['color']['system'])
+    semaphore = asyncio.Semaphore(workers)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, 'a', encoding='utf-8') as out:
+        async def run(path: str) -> dict:
+            async with semaphore:
+                name = os.path.splitext(os.path.basename(path))[0]
+                start = time.perf_counter()
+                try:
+                    # シナリオファイルの項目（input_texts, system_prompts など）で基本設定を上書きする。
+                    # 壊れたファイルはそのシナリオだけ error にして、バッチ全体は止めない
+                    scenario = {**config, **load_config(path)}
+                    name = scenario.get('name') or name
+                    result = await run_scenario(name, scenario, llm, tools, pools, tool_cache, label=f'[{name}] ')
+                    result['status'] = 'ok'
+                except Exception as e:
+                    result = {'scenario': name, 'status': 'error', 'error': repr(e),
+                              'latency_seconds': round(time.perf_counter() - start, 3)}
+                result['file'] = path
+                out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                out.flush()
+                return result
+
+        results = await asyncio.gather(*[run(path) for path in files], return_exceptions=True)
+        # run の中で拾えなかった例外（結果の書き出しの失敗など）も error の行として集計する
+        results = [r if not isinstance(r, BaseException) else
+                   {'scenario': os.path.splitext(os.path.basename(path))[0], 'status': 'error', 'error': repr(r), 'file': path}
+                   for path, r in zip(files, results)]
+
+    ok = [r for r in results if r['status'] == 'ok']
+    latencies = sorted(r['latency_seconds'] for r in ok)
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        write_log(f'system> 成功 {len(ok)}/{len(results)}件 所要時間 中央値 {statistics.median(latencies):.2f}秒 p95 {p95:.2f}秒 '
+                  f'ツール呼び出し {sum(r["tool_calls"] for r in ok)}回 '
+                  f'トークン {sum(r["prompt_tokens"] + r["completion_tokens"] for r in ok)}', color=config['color']['system'])
+    write_log(f'system> 結果を出力しました: {output}', color=config['color']['system'])
+    return results
+
+def show_report(config: dict):
+    report_folder = config['report_folder']
+    if not os.path.exists(report_folder):
+        os.makedirs(report_folder)
+    files = os.listdir(report_folder)
+    report_files = [f for f in files if f.startswith('checklist-result-') and f.endswith('.xlsx')]
+    if report_files:
+        recent_file = max(report_files, key=lambda f: os.path.getmtime(os.path.join(report_folder, f)))
+        write_log(f'system> レポートを開きます...{recent_file}', color=config['color']['system'])
+        if sys.platform == "win32":
+            os.system(f'powershell -Command "{report_folder}\\{recent_file}"')
+        elif sys.platform == "darwin":
+            os.system(f'open "{os.path.join(report_folder, recent_file)}"')
+        else:
+            os.system(f'xdg-open "{os.path.join(report_folder, recent_file)}"')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='電柱チェック業務のシナリオを自動実行します')
+    parser.add_argument('config', nargs='?', default=DEFAULT_CONFIG, help='設定ファイル（app.json）')
+    parser.add_argument('--batch', metavar='DIR', help='シナリオJSONのディレクトリ。指定すると並列に実行する')
+    parser.add_argument('--workers', type=int, help='バッチの並列数（既定: batch_workers）')
+    parser.add_argument('--output', help='バッチ結果（JSONL）の出力先')
+    return parser.parse_args()
+
 async def main():
-    args = sys.argv
-    config_path = args[1] if len(args) >= 2 else DEFAULT_CONFIG
-    config = load_config(config_path)
-    setup_logging(config['log_folder'])
+    args = parse_args()
+    config = load_config(args.config)
+    # 画面表示とファイル出力はバックグラウンドのスレッドで行う（log_* の設定）
+    async_log.setup_logging(config['log_folder'], config)
     os.environ['TEMP'] = config['report_folder']
     begin_time = datetime.datetime.now()
     write_log(f'system> 開始します', color=config['color']['system'])
-    
-    # MultiServerMCPClientを直接初期化（async withを使用しない）
-    client = MultiServerMCPClient(config['mcp_servers'])
+
+    workers = (args.workers or config.get('batch_workers', 4)) if args.batch else 1
+    components = await create_components(config, workers)
+    llm, http_client, pools, tool_cache, tools = components
     try:
-        tools = await client.get_tools()
-        write_log(f'system> {len(tools)}個のツールをロードしました', color=config['color']['system'])
-        for tool in tools:
-            write_log(f'system> ツール: {tool.name} - {tool.description}', color=config['color']['system'])
-        
-        llm = ChatOpenAI(
-            openai_api_base=config['openai_api_base'],
-            streaming=False,
-            temperature=0,
-            openai_api_key="EMPTY",
-            model=config['agent_model']
-        )
-        
-        write_log(f'system> agentを構築します', color=config['color']['system'])
-        sys_message = SystemMessage(content='\n'.join(config['system_prompts']))
-        agent = create_react_agent(llm, tools, prompt=sys_message, store=InMemoryStore())
-        
-        messages = []
-        for input_text in config['input_texts']:
-            write_log(f'user> {input_text}', color=config['color']['user'])
-            last_msg = None
-            message = {'role': 'user', 'content': input_text}
-            messages.append(message)
-            async for step in agent.astream({'messages': messages}):
-                last_msg = print_message_by_step(step, config['color'])
-            if last_msg is not None:
-                messages.append({'role': 'assistant', 'content': last_msg})
-        
-        if config.get('show_report'):
-            report_folder = config['report_folder']
-            if not os.path.exists(report_folder):
-                os.makedirs(report_folder)
-            files = os.listdir(report_folder)
-            report_files = [f for f in files if f.startswith('checklist-result-') and f.endswith('.xlsx')]
-            if report_files:
-                recent_file = max(report_files, key=lambda f: os.path.getmtime(os.path.join(report_folder, f)))
-                write_log(f'system> レポートを開きます...{recent_file}', color=config['color']['system'])
-                if sys.platform == "win32":
-                    os.system(f'powershell -Command "{report_folder}\\{recent_file}"')
-                elif sys.platform == "darwin":
-                    os.system(f'open "{os.path.join(report_folder, recent_file)}"')
-                else:
-                    os.system(f'xdg-open "{os.path.join(report_folder, recent_file)}"')
-        
+        if args.batch:
+            output = args.output or os.path.join(
+                config['report_folder'], f'batch-{datetime.datetime.now().strftime("%Y%m%d-%H%M")}.jsonl')
+            await run_batch(config, args.batch, workers, output, components)
+        else:
+            write_log(f'system> agentを構築します', color=config['color']['system'])
+            await run_scenario('default', config, llm, tools, pools, tool_cache)
+            if config.get('show_report'):
+                show_report(config)
+
+        write_log(f'system> ツールキャッシュ: {tool_cache.stats()["tools"]}', color=config['color']['system'])
         end_time = datetime.datetime.now()
         write_log(f'system> 切断します (所要時間:{end_time - begin_time})', color=config['color']['system'])
-    
+
     finally:
-        # クライアントのクリーンアップ（必要に応じて）
-        if hasattr(client, 'close'):
-            try:
-                await client.close()
-            except:
-                pass
+        await pools.close()
+        await http_client.aclose()
+        async_log.shutdown()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,153 @@
+"""
+トークン数の上限に収まるように会話履歴を管理する
+
+input_texts を順に送ると会話履歴が1往復ずつ伸び、毎回すべてをエージェントに送り直すため
+プロンプトが際限なく大きくなります。ここでは
+
+- システムプロンプトと直近 keep_turns 往復はそのまま送る
+- それより古い往復はバックグラウンドで要約し、要約をシステムプロンプトの後ろに付ける
+  （前回の要約に新しい往復を足して要約し直す。同じ入力の要約はキャッシュする）
+- それでも max_tokens を超える場合は古い往復から送らない
+
+ことで、1ターンあたりのプロンプトのトークン数を一定以下に保ちます。
+"""
+
+import asyncio
+import hashlib
+import logging
+import re
+from typing import Dict, List, Optional
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+import token_counter
+
+SUMMARY_INSTRUCTION = (
+    'あなたは会話の要約係です。これまでの要約と新しい会話をまとめて、'
+    '担当ID・電柱ID・各チェック項目のOK/NGと備考など、作業の続きに必要な事実だけを短い日本語の箇条書きで書いてください。'
+)
+
+# 同じ内容（前回の要約 + 新しい往復）の要約は再利用する（プロセス内で共有）
+_summary_cache: Dict[str, str] = {}
+SUMMARY_CACHE_SIZE = 1024
+# 思考部分。max_tokens で途中で切れて </think> がない場合は最後まで
+_THINK = re.compile(r'<think>.*?(?:</think>|$)', re.DOTALL)
+# qwen3 などの思考モデルで思考を省かせる指示。思考に max_tokens を使い切ると要約が空になるため
+NO_THINK = '/no_think'
+
+
+class HistoryManager:
+    """直近の往復と古い往復の要約でエージェントに送る会話履歴を組み立てる"""
+
+    def __init__(self, llm, system_prompt: str, model: Optional[str] = None, max_tokens: int = 4000,
+                 keep_turns: int = 4, summary_max_tokens: int = 300, summary_timeout: float = 30):
+        self.llm = llm
+        self.system_prompt = system_prompt
+        self.model = model
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_timeout = summary_timeout
+        self.messages: List[dict] = []
+        self.summary = ''
+        # 要約に含まれているメッセージ数（messages の先頭から）
+        self.summarized = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, llm, config: dict) -> 'HistoryManager':
+        return cls(
+            llm,
+            '\n'.join(config['system_prompts']),
+            model=config.get('agent_model'),
+            max_tokens=config.get('history_max_tokens', 4000),
+            keep_turns=config.get('history_keep_turns', 4),
+            summary_max_tokens=config.get('history_summary_max_tokens', 300),
+            summary_timeout=config.get('history_summary_timeout', 30),
+        )
+
+    def add(self, role: str, content: str):
+        self.messages.append({'role': role, 'content': content})
+
+    def system_message(self) -> SystemMessage:
+        """システムプロンプト（要約があれば後ろに付ける）"""
+        if not self.summary:
+            return SystemMessage(content=self.system_prompt)
+        return SystemMessage(content=f'{self.system_prompt}\n\nこれまでの会話の要約:\n{self.summary}')
+
+    def prompt(self, state) -> list:
+        """create_react_agent の prompt に渡す関数"""
+        return [self.system_message()] + state['messages']
+
+    def _window_start(self) -> int:
+        """そのまま送る直近 keep_turns 往復の開始位置（最後のユーザー発話を含む）"""
+        users = [i for i, m in enumerate(self.messages) if m['role'] == 'user']
+        count = self.keep_turns + 1 if self.messages and self.messages[-1]['role'] == 'user' else self.keep_turns
+        if count == 0:
+            return len(self.messages)
+        if len(users) <= count:
+            return 0
+        return users[-count]
+
+    def _count(self, messages: List[dict]) -> int:
+        system = {'role': 'system', 'content': self.system_message().content}
+        return token_counter.count_messages([system] + messages, self.model)
+
+    async def build(self) -> List[dict]:
+        """今回エージェントに送る会話履歴を返す"""
+        start = self._window_start()
+        if start > self.summarized and self._task is None:
+            self._task = asyncio.create_task(self._summarize(start))
+
+        messages = self.messages[self.summarized:]
+        if self._count(messages) > self.max_tokens and self._task is not None:
+            # 上限を超える場合は要約の完了を待つ
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), self.summary_timeout)
+            except Exception:
+                pass
+            messages = self.messages[self.summarized:]
+
+        # まだ超える場合は古いものから送らない（最後のユーザー発話は必ず送る）
+        while len(messages) > 1 and self._count(messages) > self.max_tokens:
+            messages = messages[1:]
+        while messages and messages[0]['role'] != 'user' and len(messages) > 1:
+            messages = messages[1:]
+        return messages
+
+    def prompt_tokens(self, messages: List[dict]) -> int:
+        return self._count(messages)
+
+    async def _summarize(self, end: int):
+        try:
+            while self.summarized < end:
+                turns = self.messages[self.summarized:end]
+                text = '\n'.join(f"{m['role']}: {m['content']}" for m in turns)
+                key = hashlib.sha256(f'{self.model}\n{self.summary}\n---\n{text}'.encode('utf-8')).hexdigest()
+                summary = _summary_cache.get(key)
+                if summary is None:
+                    response = await self.llm.ainvoke([
+                        SystemMessage(content=SUMMARY_INSTRUCTION),
+                        HumanMessage(content=f'これまでの要約:\n{self.summary or "なし"}\n\n新しい会話:\n{text}\n\n{NO_THINK}'),
+                    ], max_tokens=self.summary_max_tokens)
+                    summary = _THINK.sub('', response.content).strip()
+                    if not summary:
+                        # 空の要約で summarized を進めると古い往復が要約されないまま消えるので、次のターンでやり直す
+                        logging.warning('history summary is empty; keeping the unsummarized turns')
+                        break
+                    _summary_cache[key] = summary
+                    if len(_summary_cache) > SUMMARY_CACHE_SIZE:
+                        del _summary_cache[next(iter(_summary_cache))]
+                self.summary = summary
+                self.summarized = end
+                # 要約している間に古くなった往復があれば続けて要約する
+                end = self._window_start()
+        except Exception as e:
+            # 要約できなくても、次のターンは上限に収まる範囲の直近の履歴だけで続ける
+            logging.error(f'history summary failed: {e}')
+        finally:
+            self._task = None
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
@@ -24,6 +24,7 @@ HITL (Human-In-The-Loop) サンプル実装 — single-file FastAPI アプリ
  - GET  /review      : 管理者向けレビューUI
  - POST /review/{id} : レビュー結果を保存 (label + action)
  - POST /retrain     : モデル再学習をトリガー
+ - GET  /metrics     : Prometheus 形式のメトリクス
 
 注意:
  - このサンプルはローカル実行を前提としています。
@@ -35,10 +36,15 @@ from fastapi import FastAPI, Request, Form
 from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from jinja2 import Template
 import sqlite3
+import sys
 import threading
 import os
 import datetime
 
+# shared instrumentation (langchain_server/lib)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import metrics
+
 # optional sklearn imports (used if available for a real retrain)
 try:
     from sklearn.feature_extraction.text import CountVectorizer
@@ -72,6 +78,7 @@ def init_db():
     conn.close()
 
 
+@metrics.timed('db')
 def insert_item(text, predicted_label=None):
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -84,6 +91,7 @@ def insert_item(text, predicted_label=None):
     return item_id
 
 
+@metrics.timed('db')
 def update_item_review(item_id, true_label, action):
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -95,6 +103,7 @@ def update_item_review(item_id, true_label, action):
     conn.close()
 
 
+@metrics.timed('db')
 def get_all_items():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -105,6 +114,7 @@ def get_all_items():
     return [dict(zip(keys, r)) for r in rows]
 
 
+@metrics.timed('db')
 def get_pending_items():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -114,6 +124,7 @@ def get_pending_items():
     return [{'id':r[0],'text':r[1],'predicted_label':r[2]} for r in rows]
 
 
+@metrics.timed('db')
 def get_reviewed_examples():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -176,6 +187,7 @@ model = SimpleModel()
 
 # --- FastAPI app ------------------------------------------------
 app = FastAPI()
+metrics.install(app)
 init_db()
 
 # Templates (simple, embedded)
@@ -0,0 +1,169 @@
+"""
+キューを使ったノンブロッキングなログ出力
+
+write_log() はレコードをキューに入れるだけで戻り、画面表示とファイル書き込みは
+バックグラウンドのスレッド（QueueListener）が行います。イベントループ上で
+print やファイルI/Oを待たないため、負荷が高いときもログがレイテンシを増やしません。
+
+- ファイルは1行1レコードのJSON（JSON Lines）。サイズまたは経過時間でローテーションする
+- 長いメッセージ・フィールドは max_chars 文字で切り詰める
+- キューがあふれた場合は待たずに捨て、log_records_dropped_total に数える
+
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+    import async_log
+    from async_log import write_log
+
+    async_log.setup_logging(config['log_folder'], config)   # log_* の設定を読む
+    write_log('system> 開始します', color='36')
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from typing import Optional
+
+import metrics
+
+DROPPED = metrics.REGISTRY.counter('log_records_dropped_total', 'Log records dropped because the log queue was full.')
+
+DEFAULTS = {
+    'log_level': 'WARNING',          # ライブラリのログ（root）のレベル。write_log は常に INFO
+    'log_max_bytes': 10 * 1024 * 1024,
+    'log_backup_count': 5,
+    'log_rotate_seconds': 24 * 60 * 60,
+    'log_max_chars': 2000,
+    'log_queue_size': 10000,
+    'log_console': True,
+}
+
+logger = logging.getLogger('app')
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+_max_chars = DEFAULTS['log_max_chars']
+
+
+def truncate(text: str, limit: int) -> str:
+    """limit 文字を超える部分を省略する"""
+    if limit and len(text) > limit:
+        return f'{text[:limit]}...(+{len(text) - limit} chars)'
+    return text
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯なら待たずに捨てる QueueHandler"""
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.msg = truncate(record.msg, _max_chars)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+class JsonLineFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            if not isinstance(value, (int, float, bool)) and value is not None:
+                value = truncate(str(value), _max_chars)
+            entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """従来の write_log と同じ色付きの画面表示"""
+
+    def format(self, record):
+        now = datetime.datetime.fromtimestamp(record.created).strftime('%Y/%m/%d %H:%M:%S')
+        color = getattr(record, 'color', '0')
+        return f'{now} \033[{color}m{record.getMessage()}\033[0m'
+
+
+class SizeTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """サイズ（max_bytes）または経過時間（rotate_seconds）のどちらかでローテーションする"""
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, rotate_seconds: float):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds if rotate_seconds else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rotate_seconds:
+            self.rollover_at = time.time() + self.rotate_seconds
+
+
+def setup_logging(log_folder: str, options: Optional[dict] = None, prefix: str = 'mcp_ex_text'):
+    """キューとバックグラウンドの書き込みスレッドを設定する（2回目以降は何もしない）"""
+    global _listener, _queue_handler, _max_chars
+    if _listener is not None:
+        return logger
+    opts = {**DEFAULTS, **{k: v for k, v in (options or {}).items() if k in DEFAULTS}}
+    _max_chars = opts['log_max_chars']
+
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+    filename = os.path.join(log_folder, f'{prefix}.{datetime.datetime.now().strftime("%Y%m%d-%H%M")}.jsonl')
+    file_handler = SizeTimeRotatingFileHandler(
+        filename, opts['log_max_bytes'], opts['log_backup_count'], opts['log_rotate_seconds'])
+    file_handler.setFormatter(JsonLineFormatter())
+    handlers = [file_handler]
+    if opts['log_console']:
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(ConsoleFormatter())
+        handlers.append(console)
+
+    log_queue = queue.Queue(maxsize=opts['log_queue_size'])
+    root = logging.getLogger()
+    root.setLevel(opts['log_level'])
+    _queue_handler = _DroppingQueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    logger.setLevel(logging.INFO)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+    return logger
+
+
+def write_log(text: str, color: str = '0', **fields):
+    """画面とログファイルに出力する（キューに入れるだけですぐ戻る）
+
+    fields はJSONのフィールドとしてファイルにだけ出力される。
+    """
+    logger.info(text, extra={'color': color, 'fields': fields})
+
+
+def shutdown():
+    """キューに残っているログを書き出して書き込みスレッドを止める"""
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,331 @@
+"""
+起動済みMCPセッション（stdio のサーバープロセス）のプール
+
+MultiServerMCPClient の既定のツールはツール呼び出しのたびにサーバープロセスを起動するため、
+java -jar のMCPサーバーでは JVM の起動時間がリクエストの処理時間に加わります。
+ここではサーバーごとに min_size 個のセッションを起動しておき、ツール呼び出しに貸し出します。
+
+- 同時に実行されるエージェントはそれぞれ別のセッション（プロセス）を使う（最大 max_size 個）
+- 1ステップの並列なツール呼び出しも、呼び出しごとに別のセッションを使う。stdio のセッションは
+  リクエストを1本のパイプで送るので、同じセッションでは並列にしてもサーバー側で順に処理されうる
+- 借りたセッションはエージェントの実行が終わるまで持ち、次の呼び出しで使い回す。プールが上限のときは
+  ほかの実行を待たずに、自分が使用中のセッションの返却を待つ
+- 空いているセッションには定期的に ping を送り、応答しないものは作り直す
+- プロセスが異常終了したセッションは破棄して min_size まで起動し直す
+- セッションの起動時間（JVM起動を含む）は mcp_session_startup_seconds に記録する
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from langchain_mcp_adapters.tools import load_mcp_tools
+
+import metrics
+
+STARTUP_LATENCY = metrics.REGISTRY.histogram(
+    'mcp_session_startup_seconds', 'Time to start an MCP server process and initialize its session.',
+    buckets=[0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0],
+)
+CHECKOUT_WAIT = metrics.REGISTRY.histogram(
+    'mcp_pool_checkout_wait_seconds', 'Time spent waiting for a pooled MCP session.',
+)
+POOL_SESSIONS = metrics.REGISTRY.gauge('mcp_pool_sessions', 'Pooled MCP sessions by state (idle, busy).')
+RESTARTS = metrics.REGISTRY.counter('mcp_session_restarts_total', 'MCP sessions replaced after a crash or failed health check.')
+
+# エージェント実行中に借りているセッション
+_scope: ContextVar[Optional['_Scope']] = ContextVar('mcp_session_scope', default=None)
+
+
+class _Member:
+    """プール内の1セッション。セッションの開始と終了は専用のタスクで行う"""
+
+    def __init__(self):
+        self.session = None
+        self.alive = False
+        self.started = asyncio.Event()
+        self.stop = asyncio.Event()
+        self.task = None
+        self.error = None
+
+
+class MCPSessionPool:
+    """1つのMCPサーバーの起動済みセッションのプール"""
+
+    def __init__(self, name: str, session_factory, min_size: int = 1, max_size: int = 4,
+                 health_interval: float = 30.0, ping_timeout: float = 5.0):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        self._factory = session_factory
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._members = set()
+        self._size = 0
+        self._busy = 0
+        self._closing = False
+        self._health_task = None
+
+    async def start(self):
+        """min_size 個のセッションを並行して起動し、ヘルスチェックを開始する"""
+        members = await asyncio.gather(*[self._start_member() for _ in range(self.min_size)])
+        for member in members:
+            self._idle.put_nowait(member)
+        self._update_gauges()
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _start_member(self) -> _Member:
+        member = _Member()
+        self._size += 1
+        self._members.add(member)
+        member.task = asyncio.create_task(self._run_member(member))
+        await member.started.wait()
+        if not member.alive:
+            raise RuntimeError(f'MCPサーバー {self.name} を起動できません: {member.error}') from member.error
+        return member
+
+    async def _run_member(self, member: _Member):
+        start = time.perf_counter()
+        try:
+            async with self._factory() as session:
+                STARTUP_LATENCY.observe(time.perf_counter() - start, server=self.name)
+                member.session = session
+                member.alive = True
+                member.started.set()
+                await member.stop.wait()
+        except Exception as e:
+            member.error = e
+            if member.alive and not member.stop.is_set():
+                logging.error(f'MCP session {self.name} terminated: {e}')
+        finally:
+            crashed = member.alive and not member.stop.is_set() and not self._closing
+            member.alive = False
+            member.started.set()
+            self._size -= 1
+            self._members.discard(member)
+            self._update_gauges()
+            if crashed:
+                # プロセスの異常終了など。min_size まで起動し直す
+                RESTARTS.inc(server=self.name)
+                asyncio.create_task(self._replenish())
+
+    async def _retire(self, member: _Member):
+        member.stop.set()
+        await member.task
+
+    async def _replenish(self):
+        while not self._closing and self._size < self.min_size:
+            try:
+                self._idle.put_nowait(await self._start_member())
+            except Exception as e:
+                # 次のヘルスチェックで再試行する
+                logging.error(f'MCP session {self.name} restart failed: {e}')
+                return
+            finally:
+                self._update_gauges()
+
+    async def acquire(self, wait: bool = True) -> Optional[_Member]:
+        """空いているセッションを借りる。なければ max_size まで起動し、それ以上は返却を待つ
+
+        wait=False のときは返却を待たずに None を返す。
+        """
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    member = self._idle.get_nowait()
+                except asyncio.QueueEmpty:
+                    if self._size < self.max_size:
+                        member = await self._start_member()
+                    elif not wait:
+                        return None
+                    else:
+                        member = await self._idle.get()
+                if member.alive:
+                    self._busy += 1
+                    self._update_gauges()
+                    return member
+        finally:
+            CHECKOUT_WAIT.observe(time.perf_counter() - start, server=self.name)
+
+    def release(self, member: _Member):
+        self._busy -= 1
+        if member.alive and not self._closing:
+            self._idle.put_nowait(member)
+        self._update_gauges()
+
+    async def _ping(self, member: _Member) -> bool:
+        if not member.alive:
+            return False
+        try:
+            await asyncio.wait_for(member.session.send_ping(), self.ping_timeout)
+            return True
+        except Exception as e:
+            logging.error(f'MCP session {self.name} health check failed: {e!r}')
+            return False
+
+    async def _health_loop(self):
+        while not self._closing:
+            await asyncio.sleep(self.health_interval)
+            members = []
+            while not self._idle.empty():
+                members.append(self._idle.get_nowait())
+            results = await asyncio.gather(*[self._ping(m) for m in members])
+            for member, ok in zip(members, results):
+                if ok:
+                    self._idle.put_nowait(member)
+                elif member.alive:
+                    RESTARTS.inc(server=self.name)
+                    await self._retire(member)
+            await self._replenish()
+
+    def _update_gauges(self):
+        POOL_SESSIONS.set(self._busy, server=self.name, state='busy')
+        POOL_SESSIONS.set(max(self._size - self._busy, 0), server=self.name, state='idle')
+
+    def stats(self) -> dict:
+        return {
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'size': self._size,
+            'busy': self._busy,
+            'startup_seconds': STARTUP_LATENCY.snapshot(server=self.name),
+            'restarts': RESTARTS.value(server=self.name),
+        }
+
+    async def close(self):
+        self._closing = True
+        if self._health_task is not None:
+            self._health_task.cancel()
+        members = list(self._members)
+        for member in members:
+            member.stop.set()
+        await asyncio.gather(*[m.task for m in members], return_exceptions=True)
+
+
+class _Borrowed:
+    """1回のエージェント実行が1つのサーバーから借りているセッション"""
+
+    def __init__(self, pool: MCPSessionPool):
+        self.pool = pool
+        self.members: List[_Member] = []
+        self.free: asyncio.Queue = asyncio.Queue()
+        self.in_use = 0
+        self.lock = asyncio.Lock()
+
+    async def checkout(self) -> _Member:
+        while True:
+            try:
+                member = self.free.get_nowait()
+            except asyncio.QueueEmpty:
+                member = await self._borrow()
+            if member.alive:
+                self.in_use += 1
+                return member
+
+    async def _borrow(self) -> _Member:
+        # 借りているセッションがすべて使用中（並列の呼び出し）ならプールから追加で借りる
+        member = await self.pool.acquire(wait=False)
+        if member is None:
+            # プールが上限のとき、ほかの実行の返却を待つのはセッションを1つも使っていないときの1呼び出しだけ。
+            # 使用中のものがあれば自分の返却を待つ（借りたままほかの実行を待つとデッドロックする）
+            async with self.lock:
+                if self.in_use == 0 and self.free.empty():
+                    member = await self.pool.acquire()
+            if member is None:
+                return await self.free.get()
+        self.members.append(member)
+        return member
+
+    def checkin(self, member: _Member):
+        self.in_use -= 1
+        self.free.put_nowait(member)
+
+    def release(self):
+        for member in self.members:
+            self.pool.release(member)
+
+
+class _Scope:
+    def __init__(self):
+        self.borrowed: Dict[str, _Borrowed] = {}
+
+    def borrow(self, pool: MCPSessionPool) -> _Borrowed:
+        if pool.name not in self.borrowed:
+            self.borrowed[pool.name] = _Borrowed(pool)
+        return self.borrowed[pool.name]
+
+
+class PooledSession:
+    """ツールに渡す ClientSession の代わり。呼び出しのたびにプールのセッションを使う"""
+
+    def __init__(self, pool: MCPSessionPool):
+        self.pool = pool
+
+    @asynccontextmanager
+    async def _session(self):
+        scope = _scope.get()
+        if scope is None:
+            # エージェント実行の外からの呼び出しは1回だけ借りる
+            member = await self.pool.acquire()
+            try:
+                yield member.session
+            finally:
+                self.pool.release(member)
+            return
+        borrowed = scope.borrow(self.pool)
+        member = await borrowed.checkout()
+        try:
+            yield member.session
+        finally:
+            borrowed.checkin(member)
+
+    async def list_tools(self, *args, **kwargs):
+        async with self._session() as session:
+            return await session.list_tools(*args, **kwargs)
+
+    async def call_tool(self, name, arguments=None, *args, **kwargs):
+        async with self._session() as session:
+            return await session.call_tool(name, arguments, *args, **kwargs)
+
+
+class MCPPools:
+    """mcp_servers の各サーバーのプールをまとめて扱う"""
+
+    def __init__(self, client, min_size: int = 1, max_size: int = 4, health_interval: float = 30.0):
+        self.pools = {
+            name: MCPSessionPool(name, lambda name=name: client.session(name), min_size, max_size, health_interval)
+            for name in client.connections
+        }
+
+    async def start(self):
+        await asyncio.gather(*[pool.start() for pool in self.pools.values()])
+
+    async def get_tools(self) -> List:
+        """各サーバーのツールを読み込む（実行時はプールのセッションで呼び出される）"""
+        tools = []
+        for pool in self.pools.values():
+            tools.extend(await load_mcp_tools(PooledSession(pool)))
+        return tools
+
+    @asynccontextmanager
+    async def scope(self):
+        """エージェント1回の実行の間、借りたセッションを使い回す（同時の呼び出しには別のセッション）"""
+        scope = _Scope()
+        token = _scope.set(scope)
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+            for borrowed in scope.borrowed.values():
+                borrowed.release()
+
+    def stats(self) -> dict:
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    async def close(self):
+        await asyncio.gather(*[pool.close() for pool in self.pools.values()])
@@ -0,0 +1,329 @@
+"""
+FastAPIサーバー共通の計測モジュール（Prometheus テキスト形式）
+
+各アプリケーションから以下のように読み込んで使います：
+
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+    import metrics
+    metrics.install(app)          # リクエスト数・処理中数・レイテンシ + /metrics
+
+    with metrics.stage_timer('llm'):
+        response = await llm.ainvoke(messages)
+
+ステージ名は llm / tool / retrieval / db を基本とします。
+LangChain のエージェントでは MetricsCallbackHandler を callbacks に渡すと
+LLM呼び出しとツール呼び出しが自動で計測されます。
+"""
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# LangChain は任意（hitl のように使わないアプリもある）
+try:
+    from langchain_core.callbacks import BaseCallbackHandler
+    LANGCHAIN_AVAILABLE = True
+except Exception:
+    BaseCallbackHandler = object
+    LANGCHAIN_AVAILABLE = False
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ''
+    body = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in items)
+    return '{' + body + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(k)} {_format_value(v)}' for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """増減する値（処理中リクエスト数など）"""
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f'{self.name}{_format_labels(k)} {_format_value(v)}' for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    """累積バケット形式のヒストグラム"""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Optional[List[float]] = None):
+        super().__init__(name, documentation)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        # label -> [バケットごとの件数..., +Inf], 合計, 件数
+        self._values: Dict[LabelKey, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self, **labels) -> dict:
+        """JSONで返すための集計値（累積バケット・合計・件数・平均）"""
+        with self._lock:
+            entry = self._values.get(_label_key(labels))
+            counts, total, count = entry if entry else ([0] * (len(self.buckets) + 1), 0.0, 0)
+            cumulative = 0
+            buckets = {}
+            for bound, n in zip(self.buckets + [float('inf')], counts):
+                cumulative += n
+                buckets[_format_value(bound)] = cumulative
+        return {'count': count, 'sum': total, 'mean': total / count if count else 0.0, 'buckets': buckets}
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets + [float('inf')], counts):
+                    cumulative += n
+                    lines.append(f'{self.name}_bucket{_format_labels(key, ("le", _format_value(bound)))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class Registry:
+    """メトリクスの登録先。render() で Prometheus テキスト形式を返す"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name: str, documentation: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'metric {name} is already registered as {metric.type_name}')
+            return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter, name, documentation)
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge, name, documentation)
+
+    def histogram(self, name: str, documentation: str, buckets: Optional[List[float]] = None) -> Histogram:
+        return self._register(Histogram, name, documentation, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter('http_requests_total', 'Total HTTP requests by method, path and status.')
+HTTP_IN_FLIGHT = REGISTRY.gauge('http_requests_in_flight', 'HTTP requests currently being processed.')
+HTTP_LATENCY = REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency until response headers are sent.')
+STAGE_LATENCY = REGISTRY.histogram('stage_duration_seconds', 'Latency of processing stages (llm, tool, retrieval, db).')
+STAGE_ERRORS = REGISTRY.counter('stage_errors_total', 'Errors raised inside processing stages.')
+
+
+@contextmanager
+def stage_timer(stage: str, **labels):
+    """処理ステージ（llm / tool / retrieval / db）の所要時間を計測する"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage, **labels)
+        raise
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage=stage, **labels)
+
+
+def timed(stage: str, **labels):
+    """関数全体を stage_timer で計測するデコレータ（同期・非同期どちらにも使える）"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage_timer(stage, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """LangChain のコールバックで LLM・ツール・リトリーバーの所要時間を計測する"""
+
+    def __init__(self):
+        self._starts: Dict[object, Tuple[str, dict, float]] = {}
+
+    def _start(self, run_id, stage: str, **labels):
+        self._starts[run_id] = (stage, labels, time.perf_counter())
+
+    def _end(self, run_id, error: bool = False):
+        entry = self._starts.pop(run_id, None)
+        if entry is None:
+            return
+        stage, labels, start = entry
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage=stage, **labels)
+        if error:
+            STAGE_ERRORS.inc(stage=stage, **labels)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, 'llm')
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, 'llm')
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        name = (serialized or {}).get('name') or kwargs.get('name') or 'unknown'
+        self._start(run_id, 'tool', tool=name)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id, 'retrieval')
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+
+def install(app, path: str = '/metrics'):
+    """FastAPI アプリにリクエスト計測ミドルウェアと /metrics エンドポイントを追加する"""
+    from fastapi.responses import PlainTextResponse
+
+    @app.middleware('http')
+    async def metrics_middleware(request, call_next):
+        method = request.method
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # パスはルート定義（/review/{item_id} など）でまとめる
+            route = request.scope.get('route')
+            route_path = getattr(route, 'path', 'unmatched')
+            HTTP_LATENCY.observe(time.perf_counter() - start, method=method, path=route_path)
+            HTTP_REQUESTS.inc(method=method, path=route_path, status=status)
+
+    @app.get(path, include_in_schema=False)
+    async def metrics_endpoint():
+        return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+    return app
@@ -0,0 +1,244 @@
+"""
+トークン数の計測とクライアントごとのトークンレート制限
+
+- count_tokens / count_messages: tiktoken でトークン数を数える
+  エンコーダーはモデルごとにキャッシュし、メッセージ単位の結果もキャッシュするため、
+  毎ターン送り直される会話履歴を何度もトークナイズしない。
+  長いテキストは一定の長さごとに分割して順に数える。
+- TokenRateLimiter: クライアントごとのトークンバケット（tokens/分）
+
+tiktoken が知らないモデル（qwen3 など）は o200k_base で近似します。
+エンコーディングを取得できない環境（オフラインなど）では文字種ベースの概算に切り替え、警告をログに出します。
+
+初回のエンコーディングの取得では tiktoken がファイルを同期でダウンロードすることがあるため、
+サーバーは起動時に warm_up() でイベントループの外で取得しておきます。取得に失敗したモデルは
+RETRY_SECONDS 秒ごとにバックグラウンドのスレッドで取得し直し、それまでは概算で数えます。
+"""
+
+import asyncio
+import functools
+import logging
+import hashlib
+import math
+import re
+import threading
+import time
+from typing import Iterable, List, Optional
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except Exception:
+    TIKTOKEN_AVAILABLE = False
+
+# tiktoken が知らないモデルに使うエンコーディング（日本語の分割が cl100k_base より実際に近い）
+FALLBACK_ENCODING = 'o200k_base'
+# エンコーディングの取得に失敗したとき、取得し直すまでの秒数
+RETRY_SECONDS = 300
+# これより長いテキストは分割して数える
+CHUNK_CHARS = 8192
+# OpenAI のチャット形式で1メッセージ・返答開始ごとに加算されるトークン数
+TOKENS_PER_MESSAGE = 3
+TOKENS_FOR_REPLY = 3
+
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ]')
+_WORD = re.compile(r'[A-Za-z0-9_]+')
+
+
+def approximate_tokens(text: str) -> int:
+    """エンコーダーが使えない場合の概算（CJKは1文字1トークン、英数字は4文字1トークン）"""
+    cjk = len(_CJK.findall(text))
+    words = _WORD.findall(text)
+    word_tokens = sum(math.ceil(len(w) / 4) for w in words)
+    others = len(text) - cjk - sum(len(w) for w in words) - len(re.findall(r'\s', text))
+    return cjk + word_tokens + max(others, 0)
+
+
+logger = logging.getLogger(__name__)
+
+# モデル -> エンコーダー（取得に失敗したモデルは None）
+_encodings = {}
+# 取得に失敗したモデル -> 失敗した時刻（time.monotonic）
+_failed_at = {}
+_encoding_lock = threading.Lock()
+
+
+def load_encoding(model: Optional[str] = None):
+    """エンコーダーを取得してキャッシュする（ダウンロードが起きうるのでイベントループの外で呼ぶ）"""
+    encoding = None
+    if TIKTOKEN_AVAILABLE:
+        try:
+            if model:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    pass
+            if encoding is None:
+                encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
+        except Exception as e:
+            logger.warning('tiktoken encoding for %s unavailable, using approximation (retry in %ds): %s',
+                           model or FALLBACK_ENCODING, RETRY_SECONDS, e)
+    with _encoding_lock:
+        _encodings[model] = encoding
+        if encoding is None and TIKTOKEN_AVAILABLE:
+            _failed_at[model] = time.monotonic()
+        elif _failed_at.pop(model, None) is not None:
+            # 概算で数えた結果が残らないようにする
+            count_cached.cache_clear()
+            logger.info('tiktoken encoding for %s is available again', model or FALLBACK_ENCODING)
+    return encoding
+
+
+def get_encoding(model: Optional[str] = None):
+    """モデルに対応するエンコーダーを返す。使えなければ None（概算で数える）
+
+    warm_up() していないモデルはここで取得する。失敗したモデルは RETRY_SECONDS 秒たつと
+    バックグラウンドのスレッドで取得し直し、この呼び出しは待たない。
+    """
+    with _encoding_lock:
+        if model in _encodings:
+            failed_at = _failed_at.get(model)
+            if failed_at is not None and time.monotonic() - failed_at >= RETRY_SECONDS:
+                # 取得し直している間に重ねて起動しない
+                _failed_at[model] = time.monotonic()
+                threading.Thread(target=load_encoding, args=(model,), daemon=True).start()
+            return _encodings[model]
+    return load_encoding(model)
+
+
+async def warm_up(models: Iterable[Optional[str]] = (None,)):
+    """サーバーの起動時に、使うモデルのエンコーダーをイベントループの外で取得しておく"""
+    for model in set(models):
+        await asyncio.to_thread(load_encoding, model)
+
+
+def _split(text: str, size: int) -> Iterable[str]:
+    """改行・空白の位置でおおよそ size 文字ごとに分割する"""
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind('\n', start, end), text.rfind(' ', start, end))
+            if cut > start:
+                end = cut + 1
+        yield text[start:end]
+        start = end
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """テキストのトークン数を数える"""
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return approximate_tokens(text)
+    if len(text) <= CHUNK_CHARS:
+        return len(encoding.encode(text, disallowed_special=()))
+    return sum(len(encoding.encode(chunk, disallowed_special=())) for chunk in _split(text, CHUNK_CHARS))
+
+
+@functools.lru_cache(maxsize=4096)
+def count_cached(text: str, model: Optional[str] = None) -> int:
+    """同じテキストの再計算を避けるキャッシュ付きの count_tokens"""
+    return count_tokens(text, model)
+
+
+def count_messages(messages: List[dict], model: Optional[str] = None) -> int:
+    """OpenAI形式のメッセージ列のプロンプトトークン数を数える
+
+    メッセージごとの結果をキャッシュするので、会話履歴が毎回送られてきても
+    新しく増えたメッセージだけがトークナイズされる。
+    """
+    total = TOKENS_FOR_REPLY
+    for m in messages:
+        content = m.get('content') or ''
+        if not isinstance(content, str):
+            content = ' '.join(p.get('text', '') for p in content if isinstance(p, dict))
+        total += TOKENS_PER_MESSAGE + count_cached(m.get('role', ''), model) + count_cached(content, model)
+    return total
+
+
+def usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    """OpenAI 形式の usage を作成"""
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+
+
+class TokenRateLimiter:
+    """クライアントごとのトークンバケットでトークン消費量を制限する
+
+    tokens_per_minute の速度で最大 burst トークンまで回復する。
+    リクエスト時にプロンプトのトークン数を確保し、応答後に生成分を追加で消費する
+    （残高がマイナスになった場合は回復するまで次のリクエストを断る）。
+    """
+
+    def __init__(self, tokens_per_minute: float, burst: Optional[float] = None, max_clients: int = 10000):
+        self.rate = tokens_per_minute / 60.0
+        self.burst = burst if burst is not None else tokens_per_minute
+        self.max_clients = max_clients
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _refill(self, client: str, now: float) -> float:
+        tokens, updated = self._buckets.get(client, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def _prune(self, now: float):
+        # 満タンまで回復したクライアントは記録不要なので削除する
+        full = [c for c in self._buckets if self._refill(c, now) >= self.burst]
+        for client in full:
+            del self._buckets[client]
+
+    def try_acquire(self, client: str, tokens: int) -> float:
+        """確保できれば 0、できなければ再試行までの秒数を返す"""
+        now = time.monotonic()
+        with self._lock:
+            available = self._refill(client, now)
+            # バースト上限より大きいリクエストは満タンなら通す
+            needed = min(tokens, self.burst)
+            if available < needed:
+                self._buckets[client] = (available, now)
+                return (needed - available) / self.rate if self.rate > 0 else float('inf')
+            self._buckets[client] = (available - tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._prune(now)
+            return 0.0
+
+    def check(self, client: str, tokens: int):
+        """FastAPI 用: 確保できなければ 429 を Retry-After 付きで送出する"""
+        from fastapi import HTTPException
+        wait = self.try_acquire(client, tokens)
+        if wait > 0:
+            retry_after = str(math.ceil(wait)) if wait != float('inf') else '60'
+            raise HTTPException(status_code=429, detail='Token rate limit exceeded',
+                                headers={'Retry-After': retry_after})
+
+    def consume(self, client: str, tokens: int):
+        """応答後に生成トークン数を追加で消費する"""
+        now = time.monotonic()
+        with self._lock:
+            self._buckets[client] = (self._refill(client, now) - tokens, now)
+
+
+def client_id(request, trust_headers: bool = False) -> str:
+    """レート制限のクライアント識別子
+
+    既定では認証済みの識別子（認証のミドルウェアが request.state.client_id に設定したもの）、
+    なければ接続元IP。X-Client-Id・Authorization ヘッダーはクライアントが自由に変えられ、
+    リクエストごとに変えれば制限を逃れられるので、信頼できるプロキシの後ろで trust_headers=True
+    のときだけ使う（X-Client-Id > Authorization）。
+    """
+    authenticated = getattr(request.state, 'client_id', None)
+    if authenticated:
+        return str(authenticated)
+    if trust_headers:
+        header = request.headers.get('x-client-id')
+        if header:
+            return header
+        auth = request.headers.get('authorization')
+        if auth:
+            return 'key:' + hashlib.sha1(auth.encode('utf-8')).hexdigest()[:16]
+    return request.client.host if request.client else 'unknown'
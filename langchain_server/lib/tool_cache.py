@@ -0,0 +1,169 @@
+"""
+読み取り専用のMCPツールの結果をセッションごとにキャッシュするラッパー
+
+エージェントは同じセッションの中で「残りのチェック項目」のような読み取り専用のツールを
+同じ引数で何度も呼び出します。app.json の cacheable_tools に挙げたツールの結果を
+セッションごとに tool_cache_ttl_seconds 秒キャッシュします。
+
+- キーはツール名と引数（JSON）。セッションは session() で切り替える（既定は 'default'）
+- cacheable_tools にないツールは更新系とみなし、実行するとそのセッションのキャッシュを消す
+- cacheable_tools が空ならツールをラップしない（キャッシュするものがないので、消す処理も省く）
+- ツール名はMCPサーバー次第なので、起動時に表示されるツール一覧から読み取り専用のものを選んで設定する。
+  describe() で設定の状態（存在しない名前を含む）を確認できる
+- ツールがエラーになった場合はキャッシュしない
+- ヒット・ミスの件数は tool_cache_requests_total{tool, result} に記録する
+
+    tool_cache = ToolCache.from_config(config)
+    tools = tool_cache.wrap(await client.get_tools())
+    with tool_cache.session(thread_id):
+        result = await agent.ainvoke(...)
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, List, Optional
+
+from langchain_core.tools import StructuredTool
+
+import metrics
+
+REQUESTS = metrics.REGISTRY.counter('tool_cache_requests_total', 'Cacheable tool calls by tool and result (hit, miss).')
+INVALIDATIONS = metrics.REGISTRY.counter('tool_cache_invalidations_total', 'Session tool caches cleared by a mutating tool call.')
+
+_session: ContextVar[str] = ContextVar('tool_cache_session', default='default')
+
+
+class _SessionCache:
+    def __init__(self):
+        self.entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        # 更新系ツールが実行されるたびに増える。実行中に更新が入った読み取り結果は保存しない
+        self.generation = 0
+
+
+class ToolCache:
+    """セッションごとのTTL付きツール結果キャッシュ"""
+
+    def __init__(self, cacheable: Iterable[str], ttl_seconds: float = 60, max_sessions: int = 1000,
+                 max_entries: int = 256):
+        self.cacheable = set(cacheable)
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_entries = max_entries
+        self._sessions: 'OrderedDict[str, _SessionCache]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._tools: List[str] = []
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'ToolCache':
+        return cls(
+            config.get('cacheable_tools', []),
+            ttl_seconds=config.get('tool_cache_ttl_seconds', 60),
+            max_sessions=config.get('tool_cache_max_sessions', 1000),
+        )
+
+    @staticmethod
+    @contextmanager
+    def session(session_id: str):
+        """この中で呼ばれたツールは session_id のキャッシュを使う"""
+        token = _session.set(session_id)
+        try:
+            yield
+        finally:
+            _session.reset(token)
+
+    def _get_session(self, session_id: str) -> _SessionCache:
+        with self._lock:
+            cache = self._sessions.get(session_id)
+            if cache is None:
+                cache = self._sessions[session_id] = _SessionCache()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            return cache
+
+    def invalidate(self, session_id: Optional[str] = None):
+        """セッションのキャッシュを消す（省略時は現在のセッション）"""
+        cache = self._get_session(session_id or _session.get())
+        with self._lock:
+            cache.entries.clear()
+            cache.generation += 1
+
+    def wrap(self, tools: list) -> list:
+        """ツールをキャッシュ付きのツールに置き換える（cacheable_tools が空ならそのまま返す）"""
+        self._tools = [tool.name for tool in tools]
+        if not self.cacheable:
+            return list(tools)
+        return [self._wrap(tool) for tool in tools]
+
+    def describe(self) -> str:
+        """起動時に表示する設定の状態"""
+        if not self.cacheable:
+            return 'ツール結果のキャッシュは無効です（app.json の cacheable_tools に読み取り専用のツール名を設定すると有効）'
+        text = f'結果をキャッシュするツール: {", ".join(sorted(self.cacheable & set(self._tools)))}'
+        unknown = sorted(self.cacheable - set(self._tools))
+        if unknown:
+            text += f'（MCPサーバーにないツール名: {", ".join(unknown)}）'
+        return text
+
+    def _wrap(self, tool):
+        if tool.coroutine is None:
+            return tool
+        cacheable = tool.name in self.cacheable
+        call = tool.coroutine
+
+        async def cached_call(**arguments):
+            cache = self._get_session(_session.get())
+            if not cacheable:
+                # 更新系のツール: 実行後にセッションのキャッシュを消す（失敗しても状態が変わっている可能性がある）
+                try:
+                    return await call(**arguments)
+                finally:
+                    self.invalidate()
+                    INVALIDATIONS.inc(tool=tool.name)
+
+            key = tool.name + ':' + json.dumps(arguments, sort_keys=True, ensure_ascii=False, default=str)
+            now = time.monotonic()
+            with self._lock:
+                entry = cache.entries.get(key)
+                if entry is not None and entry[0] > now:
+                    cache.entries.move_to_end(key)
+                    REQUESTS.inc(tool=tool.name, result='hit')
+                    return entry[1]
+                generation = cache.generation
+            REQUESTS.inc(tool=tool.name, result='miss')
+            result = await call(**arguments)
+            with self._lock:
+                if cache.generation == generation:
+                    cache.entries[key] = (time.monotonic() + self.ttl_seconds, result)
+                    cache.entries.move_to_end(key)
+                    while len(cache.entries) > self.max_entries:
+                        cache.entries.popitem(last=False)
+            return result
+
+        return StructuredTool(
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema,
+            coroutine=cached_call,
+            response_format=tool.response_format,
+            metadata=tool.metadata,
+        )
+
+    def stats(self) -> dict:
+        tools = {}
+        for name in sorted(self.cacheable):
+            hits = REQUESTS.value(tool=name, result='hit')
+            misses = REQUESTS.value(tool=name, result='miss')
+            total = hits + misses
+            tools[name] = {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else 0.0}
+        return {
+            'ttl_seconds': self.ttl_seconds,
+            'sessions': len(self._sessions),
+            'tools': tools,
+            'unknown_cacheable_tools': sorted(self.cacheable - set(self._tools)),
+        }
@@ -0,0 +1,128 @@
+"""
+optimize_blend の単発呼び出しと optimize_blend_batch のスループット比較
+
+需要量と価格を振ったシナリオを作り、次の方法で解いたときの1秒あたりのシナリオ数を出力します。
+
+- single:   1シナリオ1リクエストを順に送る（keep-alive）
+- parallel: 1シナリオ1リクエストを --concurrency 本の接続から同時に送る
+- batch:    optimize_blend_batch で全シナリオを1リクエストで送り、NDJSON を読みながら最初の結果までの時間も測る
+
+方法ごとに価格の乱数を変えるので、サーバーの結果キャッシュには当たりません。
+
+    python mcp_blend_server.py --workers 4
+    python bench_blend_batch.py --scenarios 200 --concurrency 4
+"""
+
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+OILS = [
+    {"name": "Soybean", "cost": 1.1, "iodine": 120},
+    {"name": "Palm", "cost": 0.9, "iodine": 80},
+    {"name": "Rapeseed", "cost": 1.0, "iodine": 110},
+    {"name": "Sunflower", "cost": 1.2, "iodine": 130},
+]
+
+def make_scenarios(count, seed):
+    """需要量（500〜2000）と各油脂の価格（±20%）を振ったシナリオ"""
+    rng = random.Random(seed)
+    scenarios = []
+    for i in range(count):
+        oils = [{**oil, "cost": round(oil["cost"] * rng.uniform(0.8, 1.2), 4)} for oil in OILS]
+        scenarios.append({"oils": oils, "demand": 500 + 1500 * i / max(count - 1, 1)})
+    return scenarios
+
+def connect(url):
+    parsed = urlparse(url)
+    return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=300)
+
+def post(conn, payload):
+    conn.request("POST", "/", json.dumps(payload), {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    body = json.loads(response.read())
+    if response.status != 200 or "error" in body:
+        raise RuntimeError(f"{response.status} {body}")
+    return body
+
+def run_single(url, scenarios):
+    conn = connect(url)
+    for scenario in scenarios:
+        post(conn, {"tool_id": "optimize_blend", "input": scenario})
+    conn.close()
+
+def run_parallel(url, scenarios, concurrency):
+    errors = []
+
+    def worker(part):
+        conn = connect(url)
+        try:
+            for scenario in part:
+                post(conn, {"tool_id": "optimize_blend", "input": scenario})
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker, args=(scenarios[i::concurrency],)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def run_batch(url, scenarios):
+    """最初の結果が届くまでの秒数を返す"""
+    conn = connect(url)
+    start = time.perf_counter()
+    conn.request("POST", "/", json.dumps({"tool_id": "optimize_blend_batch", "input": {"scenarios": scenarios}}),
+                 {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"{response.status} {response.read()}")
+    first = None
+    results = 0
+    for line in response:
+        record = json.loads(line)
+        if "error" in record:
+            raise RuntimeError(record)
+        if "index" in record:
+            results += 1
+            first = first or time.perf_counter() - start
+    conn.close()
+    if results != len(scenarios):
+        raise RuntimeError(f"{results}/{len(scenarios)} results")
+    return first
+
+def main():
+    parser = argparse.ArgumentParser(description="optimize_blend の単発とバッチのスループット比較")
+    parser.add_argument("--url", default="http://localhost:9100")
+    parser.add_argument("--scenarios", type=int, default=100, help="シナリオ数")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel の接続数")
+    parser.add_argument("--modes", default="single,parallel,batch", help="実行する方法（カンマ区切り）")
+    args = parser.parse_args()
+
+    for seed, mode in enumerate(args.modes.split(",")):
+        scenarios = make_scenarios(args.scenarios, seed=int(time.time()) * 10 + seed)
+        start = time.perf_counter()
+        extra = ""
+        if mode == "single":
+            run_single(args.url, scenarios)
+        elif mode == "parallel":
+            run_parallel(args.url, scenarios, args.concurrency)
+            extra = f" (接続数 {args.concurrency})"
+        elif mode == "batch":
+            first = run_batch(args.url, scenarios)
+            extra = f" (最初の結果まで {first:.3f}秒)"
+        else:
+            parser.error(f"unknown mode: {mode}")
+        seconds = time.perf_counter() - start
+        print(f"{mode:>8}: {len(scenarios)}件 {seconds:.2f}秒 {len(scenarios) / seconds:.1f}件/秒{extra}")
+
+if __name__ == "__main__":
+    main()
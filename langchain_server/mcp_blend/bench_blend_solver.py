@@ -0,0 +1,115 @@
+"""
+optimize_blend の解法と CBC の照合と速度比較
+
+ランダムな問題を PuLP + CBC と次の方法で解き、結果が一致するかと1問あたりの時間を出力します。
+サーバーは使わず、このプロセスの中で解きます。
+
+- analytic: 2制約のLPの高速解法（blend_analytic.py。扱えない問題は数えない）
+- model:    コンパイル済みテンプレート（blend_model.py）。同じ構造の問題が続くので2問目からは係数の差し替えだけ
+- cold:     問題ごとに新しいテンプレートをコンパイルして解く（model との差がテンプレートの再利用の効果）
+
+判定:
+- 一致: 総コストと配合量が --tolerance（相対誤差）以内で同じ。どちらも最適解なし（実行不能など）も一致
+- 別解: 総コストは同じで配合量が違う（同じコストの最適解が複数ある）
+- 不一致: 総コストが違う、または片方だけ解けた（あれば終了コード 1）
+
+    python bench_blend_solver.py --problems 300
+    python bench_blend_solver.py --problems 300 --general   # 複数の品質制約と供給量の上限
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+
+from blend_analytic import optimize_blend_analytic
+from blend_model import DEFAULT_MIN_IODINE, BlendSpec, BlendTemplate, highspy, optimize_blend_model
+from mcp_blend_server import optimize_blend_cbc
+
+def make_problem(rng, max_oils, general):
+    oils = [{"name": f"Oil{i}", "cost": round(rng.uniform(0.5, 1.5), 3), "iodine": rng.randint(60, 140)}
+            for i in range(rng.randint(2, max_oils))]
+    inp = {"oils": oils, "demand": rng.choice([100, 1000, 2500, round(rng.uniform(1, 5000), 2)])}
+    if general:
+        for oil in oils:
+            oil["oleic"] = rng.randint(10, 80)
+            if rng.random() < 0.5:
+                oil["supply"] = round(inp["demand"] * rng.uniform(0.2, 0.8), 2)
+        inp["quality"] = {"iodine": {"min": rng.randint(90, 110), "max": 130}, "oleic": {"min": rng.randint(20, 40)}}
+    return inp
+
+def solve_cold(inp):
+    spec = BlendSpec.from_input(inp)
+    x, objective = BlendTemplate(spec.structure).solve(spec)
+    return {"blend": dict(zip(spec.names, x.tolist())), "total_cost": objective}
+
+CANDIDATES = {
+    "analytic": lambda inp: optimize_blend_analytic(inp, DEFAULT_MIN_IODINE),
+    "model": optimize_blend_model,
+    "cold": solve_cold,
+}
+
+def close(x, y, tolerance):
+    return abs(x - y) <= tolerance * max(1.0, abs(x), abs(y))
+
+def timed(solver, inp):
+    """(出力, 秒)。最適解がなければ出力は ValueError"""
+    start = time.perf_counter()
+    try:
+        output = solver(inp)
+    except ValueError as e:
+        output = e
+    return output, time.perf_counter() - start
+
+def compare(output, expected, tolerance):
+    if isinstance(output, ValueError) or isinstance(expected, ValueError):
+        return "一致" if isinstance(output, ValueError) and isinstance(expected, ValueError) else "不一致"
+    if not close(output["total_cost"], expected["total_cost"], tolerance):
+        return "不一致"
+    if all(close(output["blend"][name], value or 0.0, tolerance) for name, value in expected["blend"].items()):
+        return "一致"
+    return "別解"
+
+def main():
+    parser = argparse.ArgumentParser(description="optimize_blend の解法と CBC の照合と速度比較")
+    parser.add_argument("--problems", type=int, default=200, help="問題数")
+    parser.add_argument("--max-oils", type=int, default=8, help="1問の油脂の最大数")
+    parser.add_argument("--general", action="store_true", help="複数の品質制約と供給量の上限を付ける")
+    parser.add_argument("--candidates", default="analytic,model,cold", help="CBC と比べる解法（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="一致とみなす相対誤差")
+    args = parser.parse_args()
+
+    candidates = args.candidates.split(",")
+    rng = random.Random(args.seed)
+    counts = {name: {"一致": 0, "別解": 0, "不一致": 0} for name in candidates}
+    times = {name: [] for name in ["cbc"] + candidates}
+    for _ in range(args.problems):
+        inp = make_problem(rng, args.max_oils, args.general)
+        expected, seconds = timed(optimize_blend_cbc, inp)
+        times["cbc"].append(seconds)
+        for name in candidates:
+            output, seconds = timed(CANDIDATES[name], inp)
+            if output is None:
+                continue  # analytic で扱わない問題
+            times[name].append(seconds)
+            result = compare(output, expected, args.tolerance)
+            counts[name][result] += 1
+            if result == "不一致":
+                print(f"不一致（{name}）: {inp}\n  CBC: {expected}\n  {name}: {output}", file=sys.stderr)
+
+    print(f"LPソルバー: {'highspy（warm start）' if highspy is not None else 'scipy linprog'}")
+    cbc = statistics.median(times["cbc"])
+    print(f"{'cbc':>8}: {len(times['cbc'])}問 中央値 {cbc * 1000:.3f}ms")
+    for name in candidates:
+        if not times[name]:
+            print(f"{name:>8}: 0問")
+            continue
+        median = statistics.median(times[name])
+        result = ", ".join(f"{k} {v}件" for k, v in counts[name].items())
+        print(f"{name:>8}: {len(times[name])}問 中央値 {median * 1000:.3f}ms（CBC の {cbc / median:.0f}倍） {result}")
+    sys.exit(1 if any(c["不一致"] for c in counts.values()) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+optimize_blend の高速解法（CBC を起動しない）
+
+制約が「合計 = 需要量」と「平均ヨウ素価 >= 下限」の2本だけのLPは、最適解（基底解）で
+正の配合量を持つ油脂が高々2種類になります。そこで次の候補をNumPyでまとめて計算し、コストが最小のものを選びます。
+
+- 1種類だけ: ヨウ素価が下限以上の油脂を需要量すべて
+- 2種類: ヨウ素価が下限より高い油脂 i と低い油脂 j を、平均がちょうど下限になる割合で混ぜる
+
+quality（複数の品質制約）や supply（使用量の上限）を使う問題、実行不能（下限を満たす組み合わせがない）や
+数値でない入力など、ここで扱えない場合は None を返し、呼び出し側はLPソルバーで解きます。
+"""
+
+import numpy as np
+
+
+def optimize_blend_analytic(inp, min_iodine=100):
+    """optimize_blend と同じ入力・出力。min_iodine は入力にないときの下限。扱えない入力は None"""
+    try:
+        oils = inp.get("oils", [])
+        if "quality" in inp or any("supply" in o for o in oils):
+            return None
+        min_iodine = float(inp.get("min_iodine", min_iodine))
+        demand = float(inp.get("demand", 1000))
+        cost = {o["name"]: float(o["cost"]) for o in oils}
+        iodine = {o["name"]: float(o["iodine"]) for o in oils}
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    names = list(cost)
+    c = np.array([cost[name] for name in names])
+    a = np.array([iodine[name] for name in names])
+    if not names or not demand > 0 or not (np.isfinite(c).all() and np.isfinite(a).all()):
+        return None
+
+    # 1種類だけの候補（1単位あたりのコスト）
+    single = np.where(a >= min_iodine, c, np.inf)
+    # 2種類の候補: i（下限より高い）を w、j（下限より低い）を 1 - w の割合で混ぜる
+    high, low = a[:, None], a[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = (min_iodine - low) / (high - low)
+        pair = np.where((high > min_iodine) & (low < min_iodine), w * c[:, None] + (1 - w) * c[None, :], np.inf)
+
+    best_single = int(single.argmin())
+    best_pair = np.unravel_index(pair.argmin(), pair.shape)
+    if np.isinf(single[best_single]) and np.isinf(pair[best_pair]):
+        return None
+
+    blend = dict.fromkeys(names, 0.0)
+    # 同じコストなら油脂の少ない1種類の解にする
+    if single[best_single] <= pair[best_pair]:
+        blend[names[best_single]] = demand
+    else:
+        i, j = best_pair
+        blend[names[i]] = float(demand * w[i, j])
+        blend[names[j]] = demand - blend[names[i]]
+    total_cost = sum(cost[name] * blend[name] for name in names)
+    return {"blend": blend, "total_cost": total_cost}
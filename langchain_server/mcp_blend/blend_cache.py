@@ -0,0 +1,123 @@
+"""
+optimize_blend の結果キャッシュ
+
+同じ油脂リストと需要の最適化を何度も解き直さないよう、入力を正規化したハッシュをキーに結果を保存します。
+
+- 正規化: 油脂（name を持つ要素のリスト）は name 順に並べ、数値は precision 桁に丸める。
+  1000 と 1000.0、油脂の並び順の違いは同じキーになる
+- メモリ上のLRU（件数上限）。path を指定するとSQLiteにも保存し、再起動後も使う
+- ヒット・ミス・追い出しの件数を stats() で返す
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+def canonicalize(value, precision: int = 6):
+    """キーの順序・油脂の並び順・数値の表記によらない形に変換する"""
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        # -0.0 は 0.0 にそろえる
+        return round(float(value), precision) + 0.0
+    if isinstance(value, dict):
+        return {str(k): canonicalize(v, precision) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [canonicalize(v, precision) for v in value]
+        if items and all(isinstance(v, dict) and "name" in v for v in items):
+            items.sort(key=lambda v: str(v["name"]))
+        return items
+    return value
+
+
+def cache_key(tool: str, inp: dict, precision: int = 6) -> Tuple[str, dict]:
+    """(キー, 正規化した入力) を返す。ソルバーには正規化した入力を渡し、ヒットとミスで結果をそろえる"""
+    canonical = canonicalize(inp, precision)
+    payload = json.dumps({"tool": tool, "input": canonical}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest(), canonical
+
+
+class BlendCache:
+    """最適化結果のLRUキャッシュ（SQLiteへの保存は任意）"""
+
+    def __init__(self, max_entries: int = 1024, path: Optional[str] = None, precision: int = 6):
+        self.max_entries = max_entries
+        self.path = path
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS blend_cache (
+                key TEXT PRIMARY KEY,
+                output TEXT NOT NULL,
+                used_at REAL NOT NULL
+            )
+            """)
+            self._conn.commit()
+            self._load()
+
+    def _load(self):
+        """最近使ったものから max_entries 件をメモリに読み込む"""
+        rows = self._conn.execute(
+            "SELECT key, output FROM blend_cache ORDER BY used_at DESC LIMIT ?", (self.max_entries,)
+        ).fetchall()
+        for key, output in reversed(rows):
+            self._entries[key] = json.loads(output)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            output = self._entries.get(key)
+            if output is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return output
+
+    def put(self, key: str, output: dict):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = output
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+                self.evictions += 1
+            if self._conn is not None:
+                self._conn.execute("INSERT OR REPLACE INTO blend_cache (key, output, used_at) VALUES (?, ?, ?)",
+                                   (key, json.dumps(output), time.time()))
+                self._conn.executemany("DELETE FROM blend_cache WHERE key = ?", [(k,) for k in evicted])
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+            "persistent": self.path,
+        }
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,214 @@
+"""
+油脂ブレンドの一般化したモデルと、コンパイル済みLPテンプレート
+
+入力（optimize_blend の input）:
+
+    {
+      "oils": [
+        {"name": "Soybean", "cost": 1.1, "iodine": 120, "oleic": 24, "supply": 600},
+        ...
+      ],
+      "demand": 1000,
+      "quality": {"iodine": {"min": 100, "max": 125}, "oleic": {"min": 30}}
+    }
+
+- quality: 性質ごとの平均値の下限（min）・上限（max）。各油脂にその性質の値が必要。
+  省略すると従来どおり平均ヨウ素価の下限だけ（min_iodine、既定 100）
+- supply: 油脂ごとの使用量の上限（省略すると上限なし）
+
+同じ油脂の並びと品質制約の組み合わせ（構造）の問題は、制約行列の形（疎行列の非ゼロの位置）が同じです。
+構造ごとに一度だけテンプレートにコンパイルし、highspy（requirements.txt で固定）で HiGHS のモデルを保持して、
+以降はコスト・性質の値・上下限だけを差し替えて前回の基底から解き直します（warm start）。
+
+highspy がないときは scipy の linprog（HiGHS）で解きます。この場合は疎行列の添字を使い回すだけで、
+毎回行列を作って最初から解くので、テンプレートなし（cold）とほとんど速度は変わりません
+（bench_blend_solver.py で 1問 約2.2ms。highspy では約0.44ms）。
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.optimize import linprog
+from scipy.sparse import csr_matrix
+
+try:
+    import highspy
+except ImportError:
+    highspy = None
+
+# quality を省略したときの平均ヨウ素価の下限
+DEFAULT_MIN_IODINE = 100
+# 1プロセスで保持するテンプレートの数
+MAX_TEMPLATES = 32
+
+
+class BlendSpec:
+    """入力を検証して配列にしたもの"""
+
+    def __init__(self, names, cost, supply, demand, constraints, values, lower, upper):
+        self.names = names              # 油脂名（tuple）
+        self.cost = cost                # (n,)
+        self.supply = supply            # (n,) 上限なしは inf
+        self.demand = demand
+        self.constraints = constraints  # ((性質, min あり, max あり), ...)
+        self.values = values            # (性質の数, n)
+        self.lower = lower              # (性質の数,) 平均値の下限（なしは -inf）
+        self.upper = upper              # (性質の数,) 平均値の上限（なしは inf）
+
+    @property
+    def structure(self):
+        """テンプレートを共有できる問題の組み合わせのキー"""
+        return self.names, self.constraints
+
+    @classmethod
+    def from_input(cls, inp):
+        """不正な入力は ValueError"""
+        if not isinstance(inp, dict):
+            raise ValueError("input must be an object")
+        oils = inp.get("oils", [])
+        if not isinstance(oils, list) or not oils or not all(isinstance(o, dict) and "name" in o for o in oils):
+            raise ValueError("oils must be a non-empty list of objects with a name")
+        # 同じ名前の油脂は後のものを使う（従来の dict と同じ）
+        oils = list({o["name"]: o for o in oils}.values())
+        quality = inp.get("quality")
+        if quality is None:
+            quality = {"iodine": {"min": inp.get("min_iodine", DEFAULT_MIN_IODINE)}}
+        if not isinstance(quality, dict) or not all(isinstance(b, dict) for b in quality.values()):
+            raise ValueError("quality must map a property to {\"min\": ..., \"max\": ...}")
+
+        demand = _number(inp.get("demand", 1000), "demand")
+        if demand <= 0:
+            raise ValueError("demand must be positive")
+        properties = sorted(quality)
+        try:
+            cost = np.array([_number(o["cost"], "cost") for o in oils])
+            supply = np.array([_number(o.get("supply", np.inf), "supply") for o in oils])
+            values = np.array([[_number(o[p], p) for o in oils] for p in properties]).reshape(len(properties), len(oils))
+        except KeyError as e:
+            raise ValueError(f"every oil needs {e.args[0]}") from None
+        lower = np.array([_number(quality[p].get("min", -np.inf), f"{p}.min") for p in properties])
+        upper = np.array([_number(quality[p].get("max", np.inf), f"{p}.max") for p in properties])
+        constraints = tuple((p, "min" in quality[p], "max" in quality[p]) for p in properties)
+        return cls(tuple(o["name"] for o in oils), cost, supply, demand, constraints, values, lower, upper)
+
+
+def _number(value, name):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number") from None
+    if np.isnan(number):
+        raise ValueError(f"{name} must be a number")
+    return number
+
+
+class BlendTemplate:
+    """構造（油脂の並びと品質制約）ごとにコンパイルしたLP
+
+    変数は油脂ごとの使用量 x。行 0 は需要量（sum x = demand）、行 1.. は性質ごとの
+    demand * min <= sum value * x <= demand * max。非ゼロの位置は固定で、値だけを差し替える。
+    """
+
+    def __init__(self, structure):
+        self.names, self.constraints = structure
+        n, p = len(self.names), len(self.constraints)
+        self.solves = 0
+        # 列方向（CSC）の非ゼロの位置: 各列に 需要の行 + 性質の行
+        self.start = np.arange(0, (p + 1) * n + 1, p + 1, dtype=np.int32)
+        self.index = np.tile(np.arange(p + 1, dtype=np.int32), n)
+        self.columns = np.arange(n, dtype=np.int32)
+        self.rows = np.arange(p + 1, dtype=np.int32)
+        # linprog 用（highspy がないとき）: 不等式の行（min は符号を反転して <= にそろえる）。
+        # 使い回すのは添字だけで、warm start はしない
+        self.ub_rows = [(k, sign) for k, (_, has_min, has_max) in enumerate(self.constraints)
+                        for sign, present in ((-1.0, has_min), (1.0, has_max)) if present]
+        rows = len(self.ub_rows)
+        self.ub_indptr = np.arange(0, rows * n + 1, n)
+        self.ub_indices = np.tile(np.arange(n), rows)
+        self.a_eq = csr_matrix(np.ones((1, n)))
+        self.highs = None
+        self.values = None
+
+    def solve(self, spec):
+        """(使用量, 総コスト) を返す。最適解がなければ ValueError"""
+        self.solves += 1
+        if highspy is not None:
+            x, objective = self._solve_highs(spec)
+        else:
+            x, objective = self._solve_linprog(spec)
+        return np.maximum(x, 0.0) + 0.0, objective
+
+    def _row_bounds(self, spec):
+        return (np.concatenate(([spec.demand], spec.lower * spec.demand)),
+                np.concatenate(([spec.demand], spec.upper * spec.demand)))
+
+    def _solve_highs(self, spec):
+        inf = highspy.kHighsInf
+        n = len(self.names)
+        row_lower, row_upper = self._row_bounds(spec)
+        supply = np.where(np.isinf(spec.supply), inf, spec.supply)
+        if self.highs is None:
+            lp = highspy.HighsLp()
+            lp.num_col_ = n
+            lp.num_row_ = len(self.rows)
+            lp.col_cost_ = spec.cost
+            lp.col_lower_ = np.zeros(n)
+            lp.col_upper_ = supply
+            lp.row_lower_ = np.where(np.isinf(row_lower), -inf, row_lower)
+            lp.row_upper_ = np.where(np.isinf(row_upper), inf, row_upper)
+            lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+            lp.a_matrix_.start_ = self.start
+            lp.a_matrix_.index_ = self.index
+            lp.a_matrix_.value_ = np.vstack([np.ones(n), spec.values]).T.ravel()
+            self.highs = highspy.Highs()
+            self.highs.setOptionValue("output_flag", False)
+            self.highs.passModel(lp)
+        else:
+            # 前回の基底を残したまま係数と上下限だけを差し替える
+            self.highs.changeColsCost(n, self.columns, spec.cost)
+            self.highs.changeColsBounds(n, self.columns, np.zeros(n), supply)
+            self.highs.changeRowsBounds(len(self.rows), self.rows,
+                                        np.where(np.isinf(row_lower), -inf, row_lower),
+                                        np.where(np.isinf(row_upper), inf, row_upper))
+            for k, column in zip(*np.nonzero(spec.values != self.values)):
+                self.highs.changeCoeff(int(k) + 1, int(column), float(spec.values[k, column]))
+        self.values = spec.values
+        self.highs.run()
+        status = self.highs.getModelStatus()
+        if status != highspy.HighsModelStatus.kOptimal:
+            raise ValueError(f"no optimal blend: {self.highs.modelStatusToString(status)}")
+        return np.array(self.highs.getSolution().col_value), self.highs.getInfo().objective_function_value
+
+    def _solve_linprog(self, spec):
+        a_ub = b_ub = None
+        if self.ub_rows:
+            k, sign = zip(*self.ub_rows)
+            data = (np.array(sign)[:, None] * spec.values[list(k)]).ravel()
+            a_ub = csr_matrix((data, self.ub_indices, self.ub_indptr), shape=(len(self.ub_rows), len(self.names)))
+            b_ub = np.array([s * (spec.lower[i] if s < 0 else spec.upper[i]) * spec.demand for i, s in self.ub_rows])
+        result = linprog(spec.cost, A_ub=a_ub, b_ub=b_ub, A_eq=self.a_eq, b_eq=[spec.demand],
+                         bounds=np.column_stack([np.zeros(len(self.names)), spec.supply]), method="highs")
+        if result.status != 0:
+            raise ValueError(f"no optimal blend: {result.message}")
+        return result.x, result.fun
+
+
+# このプロセスのテンプレート（構造 -> BlendTemplate、LRU）
+_templates = OrderedDict()
+
+
+def template_for(spec):
+    template = _templates.get(spec.structure)
+    if template is None:
+        template = _templates[spec.structure] = BlendTemplate(spec.structure)
+        while len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+    _templates.move_to_end(spec.structure)
+    return template
+
+
+def optimize_blend_model(inp):
+    """optimize_blend をテンプレートで解く（プロセスプールで実行する）"""
+    spec = BlendSpec.from_input(inp)
+    x, objective = template_for(spec).solve(spec)
+    return {"blend": dict(zip(spec.names, x.tolist())), "total_cost": objective}
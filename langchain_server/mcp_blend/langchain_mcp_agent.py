@@ -1,48 +1,108 @@
-import requests
-import json
+import asyncio
+import os
+import sys
+import time
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage
 
-# MCPクライアント設定（シンプルなHTTPクライアント）
-class SimpleMCPClient:
-    def __init__(self, url):
-        self.url = url
-    
-    def invoke_tool(self, tool_id, input_data):
-        payload = {
-            "tool_id": tool_id,
-            "input": input_data
-        }
-        response = requests.post(self.url, json=payload)
-        return response.json()
-
-client = SimpleMCPClient("http://localhost:9100")
+# 共通ライブラリ（langchain_server/lib）
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import metrics
+from blend_cache import BlendCache, cache_key
+from mcp_client import AsyncMCPClient
+
+MCP_BLEND_URL = os.getenv("MCP_BLEND_URL", "http://localhost:9100")
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+# 説明文のキャッシュ（件数、SQLiteファイル。ファイルを省略するとメモリのみ）
+EXPLANATION_CACHE_SIZE = int(os.getenv("EXPLANATION_CACHE_SIZE", "256"))
+EXPLANATION_CACHE_FILE = os.getenv("EXPLANATION_CACHE_FILE") or None
+
+EXPLANATION_LOOKUPS = metrics.REGISTRY.counter(
+    "blend_explanation_cache_total", "Explanation cache lookups by result (hit, miss)."
+)
+
+# MCPクライアント設定（コネクションプールを使い回す非同期クライアント）
+client = AsyncMCPClient(MCP_BLEND_URL)
 
 # 使用LLM（ローカルLLMやOllamaでもOK）
 llm = ChatOpenAI(
-    openai_api_base="http://localhost:11434/v1",  # Ollama例
+    openai_api_base=OLLAMA_BASE_URL,  # Ollama例
     openai_api_key="none",
     model="qwen3:14b"
 )
 
-def get_optimal_blend():
-    oils = [
-        {"name": "Soybean", "cost": 1.1, "iodine": 120},
-        {"name": "Palm", "cost": 0.9, "iodine": 80},
-        {"name": "Rapeseed", "cost": 1.0, "iodine": 110},
-    ]
+# 同じ最適化結果には同じ説明を返すので、結果のハッシュをキーに説明文を保存する
+explanations = BlendCache(EXPLANATION_CACHE_SIZE, EXPLANATION_CACHE_FILE)
 
-    result = client.invoke_tool("optimize_blend", {"oils": oils, "demand": 1000})
-    blend = result["output"]["blend"]
-    total = result["output"]["total_cost"]
+OILS = [
+    {"name": "Soybean", "cost": 1.1, "iodine": 120},
+    {"name": "Palm", "cost": 0.9, "iodine": 80},
+    {"name": "Rapeseed", "cost": 1.0, "iodine": 110},
+]
 
-    prompt = f"""
+EXPLANATION_PROMPT = """
     以下の最適化結果をもとに、来週のブレンド方針を技術者向けに説明してください。
     結果: {blend}, 総コスト: {total:.2f}
     """
-    msg = HumanMessage(content=prompt)
-    response = llm.invoke([msg])
-    return response.content
+
+async def solve_blend():
+    """MCPサーバーで最適化し、{"blend", "total_cost"} を返す"""
+    with metrics.stage_timer("tool", tool="optimize_blend"):
+        result = await client.invoke_tool("optimize_blend", {"oils": OILS, "demand": 1000})
+    return result["output"]
+
+def explanation_key(output):
+    """最適化結果・モデル・プロンプトから説明文のキャッシュのキーを作る"""
+    return cache_key("explanation", {"model": llm.model_name, "prompt": EXPLANATION_PROMPT, "result": output},
+                     explanations.precision)[0]
+
+async def stream_optimal_blend(timings=None):
+    """最適化 → LLMによる説明の順に実行し、説明のテキストを届いた順に返す
+
+    説明がキャッシュにあればLLMを呼ばずに1回で返す。timings（dict）を渡すと、ステージごとの秒数
+    （solve_seconds / explain_seconds / first_token_seconds）と cached を入れる。
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    output = await solve_blend()
+    timings["solve_seconds"] = time.perf_counter() - start
+
+    key = explanation_key(output)
+    # EXPLANATION_CACHE_FILE を指定すると SQLite を同期で読み書きするので、イベントループの外で実行する
+    cached = await asyncio.to_thread(explanations.get, key)
+    timings["cached"] = cached is not None
+    EXPLANATION_LOOKUPS.inc(result="hit" if cached is not None else "miss")
+    start = time.perf_counter()
+    if cached is not None:
+        timings["explain_seconds"] = timings["first_token_seconds"] = 0.0
+        yield cached["text"]
+        return
+
+    msg = HumanMessage(content=EXPLANATION_PROMPT.format(blend=output["blend"], total=output["total_cost"]))
+    parts = []
+    with metrics.stage_timer("llm"):
+        async for chunk in llm.astream([msg]):
+            if not chunk.content:
+                continue
+            if not parts:
+                timings["first_token_seconds"] = time.perf_counter() - start
+            parts.append(chunk.content)
+            yield chunk.content
+    timings["explain_seconds"] = time.perf_counter() - start
+    # 最後まで生成できた説明だけを保存する
+    await asyncio.to_thread(explanations.put, key, {"text": "".join(parts)})
+
+async def get_optimal_blend(timings=None):
+    return "".join([text async for text in stream_optimal_blend(timings)])
+
+async def main():
+    try:
+        timings = {}
+        print(await get_optimal_blend(timings))
+        print(timings)
+    finally:
+        await client.aclose()
+        explanations.close()
 
 if __name__ == "__main__":
-    print(get_optimal_blend())
+    asyncio.run(main())
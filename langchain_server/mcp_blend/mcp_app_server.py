@@ -1,24 +1,133 @@
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from langchain_mcp_agent import get_optimal_blend
+from fastapi.responses import JSONResponse, StreamingResponse
+from langchain_mcp_agent import client as mcp_client, explanations, get_optimal_blend, stream_optimal_blend
 import uvicorn
 
-app = FastAPI()
+# 共通ライブラリ（langchain_server/lib）
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import metrics
+import token_counter
+
+# クライアントごとのトークンレート制限（0 なら無効）
+TOKEN_RATE_LIMIT_PER_MINUTE = float(os.getenv("TOKEN_RATE_LIMIT_PER_MINUTE", "0"))
+token_limiter = token_counter.TokenRateLimiter(TOKEN_RATE_LIMIT_PER_MINUTE) if TOKEN_RATE_LIMIT_PER_MINUTE > 0 else None
+# X-Client-Id / Authorization ヘッダーでクライアントを識別する（信頼できるプロキシの後ろでだけ有効にする）
+TRUST_CLIENT_ID_HEADER = os.getenv("TRUST_CLIENT_ID_HEADER", "false").lower() == "true"
+
+MODEL_NAME = "nautilus-llm"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # トークン数を数えるエンコーダーは最初のリクエストの前に取得しておく（初回はダウンロードが起きうる）
+    await token_counter.warm_up()
+    yield
+    await mcp_client.aclose()
+    explanations.close()
+
+app = FastAPI(lifespan=lifespan)
+metrics.install(app)
+
+def sse_event(data) -> str:
+    """SSEの1イベント分の文字列を作成"""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    return f"data: {data}\n\n"
+
+def make_chunk(completion_id: str, created: int, delta: dict, finish_reason=None) -> dict:
+    """OpenAI形式の chat.completion.chunk を作成"""
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": MODEL_NAME,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+def log_timings(timings: dict):
+    """最適化と説明のステージごとの所要時間を出力する"""
+    if "solve_seconds" not in timings:
+        return
+    explain = timings.get("explain_seconds")
+    first = timings.get("first_token_seconds")
+    print(f"[blend] solve={timings['solve_seconds']:.3f}s "
+          f"explain={f'{explain:.3f}s' if explain is not None else '-'} "
+          f"first_token={f'{first:.3f}s' if first is not None else '-'} cached={timings['cached']}")
+
+def server_timing(timings: dict) -> str:
+    """Server-Timing ヘッダー（ミリ秒）"""
+    return ", ".join(f"{name};dur={timings[key] * 1000:.1f}"
+                     for name, key in (("solve", "solve_seconds"), ("explain", "explain_seconds")) if key in timings)
+
+async def fixed_reply(text: str):
+    yield text
+
+async def stream_reply(texts, client: str, timings: dict):
+    """テキストの非同期イテレーターを chat.completion.chunk のSSEとして送出する
+
+    最初に role のチャンクを送ってから最適化を始めるので、クライアントはすぐに応答を受け取り始める。
+    """
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
+    parts = []
+    yield sse_event(make_chunk(completion_id, created, {"role": "assistant"}))
+    async for text in texts:
+        parts.append(text)
+        yield sse_event(make_chunk(completion_id, created, {"content": text}))
+    yield sse_event(make_chunk(completion_id, created, {}, finish_reason="stop"))
+    yield sse_event("[DONE]")
+    log_timings(timings)
+    if token_limiter is not None:
+        token_limiter.consume(client, token_counter.count_tokens("".join(parts)))
 
 @app.post("/v1/chat/completions")
 async def completions(req: Request):
     body = await req.json()
     messages = body.get("messages", [])
-    if any("最適ブレンド" in m["content"] for m in messages):
-        reply = get_optimal_blend()
+    prompt_tokens = token_counter.count_messages(messages)
+    client = token_counter.client_id(req, TRUST_CLIENT_ID_HEADER)
+    if token_limiter is not None:
+        token_limiter.check(client, prompt_tokens)
+    blend_requested = any("最適ブレンド" in m["content"] for m in messages)
+    timings = {}
+
+    if body.get("stream", False):
+        texts = stream_optimal_blend(timings) if blend_requested else fixed_reply("最適化コマンドを認識できません。")
+        return StreamingResponse(
+            stream_reply(texts, client, timings),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    if blend_requested:
+        reply = await get_optimal_blend(timings)
+        log_timings(timings)
     else:
         reply = "最適化コマンドを認識できません。"
-    return {"choices": [{"message": {"role": "assistant", "content": reply}}]}
+    completion_tokens = token_counter.count_tokens(reply)
+    if token_limiter is not None:
+        token_limiter.consume(client, completion_tokens)
+    headers = {}
+    if timings:
+        headers = {"Server-Timing": server_timing(timings), "X-Cache": "hit" if timings["cached"] else "miss"}
+    return JSONResponse(
+        {
+            "choices": [{"message": {"role": "assistant", "content": reply}}],
+            "usage": token_counter.usage(prompt_tokens, completion_tokens),
+        },
+        headers=headers,
+    )
 
 @app.get("/v1/models")
 async def list_models():
     return {
         "data": [
-            {"id": "nautilus-llm", "object": "model"},
+            {"id": MODEL_NAME, "object": "model"},
         ]
     }
 
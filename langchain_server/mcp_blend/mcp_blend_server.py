@@ -1,47 +1,330 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
 import json
+import math
+import multiprocessing
+import os
+import threading
+import time
 import pulp
+from blend_analytic import optimize_blend_analytic
+from blend_cache import BlendCache, cache_key
+from blend_model import DEFAULT_MIN_IODINE, BlendSpec, optimize_blend_model
 
-class MCPHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        data = self.rfile.read(content_length)
-        req = json.loads(data)
-        tool = req.get("tool_id")
-        inp = req.get("input", {})
+def optimize_blend_cbc(inp):
+    """毎回 PuLP のモデルを組み立てて CBC で解く（--solver cbc と、他の解法の照合用）"""
+    spec = BlendSpec.from_input(inp)
+    demand = spec.demand
+
+    # LP問題設定：コスト最小化
+    prob = pulp.LpProblem("BlendOptimization", pulp.LpMinimize)
+    vars = {name: pulp.LpVariable(name, lowBound=0, upBound=None if math.isinf(supply) else supply)
+            for name, supply in zip(spec.names, spec.supply.tolist())}
+    prob += pulp.lpSum([cost*vars[name] for name, cost in zip(spec.names, spec.cost.tolist())])
+    prob += pulp.lpSum(vars.values()) == demand
+    for (_, has_min, has_max), values, lower, upper in zip(spec.constraints, spec.values.tolist(),
+                                                          spec.lower.tolist(), spec.upper.tolist()):
+        average = pulp.lpSum([value*vars[name] for name, value in zip(spec.names, values)]) / demand
+        if has_min:
+            prob += average >= lower
+        if has_max:
+            prob += average <= upper
+    prob.solve(pulp.PULP_CBC_CMD(msg=False))
+    if prob.status != pulp.LpStatusOptimal:
+        raise ValueError(f"no optimal blend: {pulp.LpStatus[prob.status]}")
+
+    result = {i: vars[i].value() for i in vars}
+    total_cost = pulp.value(prob.objective)
+    return {"blend": result, "total_cost": total_cost}
+
+# プロセスプールで実行するツール（tool_id -> 関数）。--solver cbc のときは CBC_SOLVERS
+SOLVERS = {
+    "optimize_blend": optimize_blend_model,
+}
+CBC_SOLVERS = {
+    "optimize_blend": optimize_blend_cbc,
+}
 
-        if tool == "optimize_blend":
-            oils = inp.get("oils", [])
-            demand = inp.get("demand", 1000)
-            cost = {o["name"]: o["cost"] for o in oils}
-            iodine = {o["name"]: o["iodine"] for o in oils}
+# プールに渡す前にリクエストのスレッドで試す高速な解法（None を返したらプールで解く）
+FAST_SOLVERS = {
+    "optimize_blend": lambda inp: optimize_blend_analytic(inp, DEFAULT_MIN_IODINE),
+}
 
-            # LP問題設定：コスト最小化
-            prob = pulp.LpProblem("BlendOptimization", pulp.LpMinimize)
-            vars = {name: pulp.LpVariable(name, lowBound=0) for name in cost.keys()}
-            prob += pulp.lpSum([cost[i]*vars[i] for i in vars])
-            prob += pulp.lpSum([vars[i] for i in vars]) == demand
-            prob += pulp.lpSum([iodine[i]*vars[i] for i in vars]) / demand >= 100
-            prob.solve(pulp.PULP_CBC_CMD(msg=False))
+def _warm_up():
+    """ワーカープロセスを起動してソルバーのライブラリを読み込ませておく"""
+    return os.getpid()
 
-            result = {i: vars[i].value() for i in vars}
-            total_cost = pulp.value(prob.objective)
+class BlendServer(ThreadingHTTPServer):
+    """接続ごとにスレッドで受け付け、ソルバーはプロセスプールで実行するHTTPサーバー"""
+    daemon_threads = True
 
-            resp = {"output": {"blend": result, "total_cost": total_cost}}
-        else:
-            resp = {"error": f"Unknown tool {tool}"}
+    def __init__(self, address, workers, queue_size, solve_timeout, cache, solvers, fast_solvers):
+        self.workers = workers
+        self.queue_size = queue_size
+        # spawn で起動する（fork だと待ち受けソケットを引き継ぎ、サーバー終了後もポートが残る）
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        # 実行中と待ち中のジョブの合計の上限。超えたら 503 を返す
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.solve_timeout = solve_timeout
+        self.cache = cache
+        self.solvers = solvers
+        self.fast_solvers = fast_solvers
+        # 同じ入力の実行中のジョブ（同時に来た同じリクエストは1回だけ解く）
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.solves = 0
+        self.fast_solves = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.solve_seconds = 0.0
+        super().__init__(address, MCPHandler)
+
+    def solve(self, tool, inp):
+        """結果の Future を返す。キャッシュにあるか高速な解法で解ければ完了済みの Future、空きがなければ None"""
+        key, canonical = cache_key(tool, inp, self.cache.precision)
+        output = self.cache.get(key)
+        if output is None and tool in self.fast_solvers:
+            output = self.fast_solvers[tool](canonical)
+            if output is not None:
+                self.cache.put(key, output)
+                with self.lock:
+                    self.fast_solves += 1
+        if output is not None:
+            future = Future()
+            future.set_result(output)
+            return future
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if not self.slots.acquire(blocking=False):
+                self.rejected += 1
+                return None
+            try:
+                future = self.pool.submit(self.solvers[tool], canonical)
+            except Exception:
+                self.slots.release()
+                raise
+            self.inflight[key] = future
+        start = time.perf_counter()
+        # 枠はジョブが終わったときに返す（タイムアウトしても実行は続くため）
+        future.add_done_callback(lambda f: self._done(key, f, time.perf_counter() - start))
+        return future
+
+    def solve_batch(self, tool, scenarios):
+        """各シナリオを solve し、終わった順に {"index", "output" または "error"} を返すジェネレーター
+        1つのバッチが同時に使う枠は workers 件までにし、単発のリクエストが入る余地を残す"""
+        todo = deque(enumerate(scenarios))
+        pending = []  # (future, index, inp, 期限)
+        busy_since = None
+        while todo or pending:
+            while todo and len(pending) < self.workers:
+                index, inp = todo[0]
+                future = self.solve(tool, inp)
+                if future is None:
+                    break
+                todo.popleft()
+                pending.append((future, index, inp, time.monotonic() + self.solve_timeout))
+            if not pending:
+                # 他のリクエストで枠が埋まっている。timeout 秒待っても空かなければそのシナリオはエラーにする
+                busy_since = busy_since or time.monotonic()
+                if time.monotonic() - busy_since > self.solve_timeout:
+                    index, _ = todo.popleft()
+                    busy_since = None
+                    yield {"index": index, "error": "Server is busy"}
+                else:
+                    time.sleep(0.05)
+                continue
+            busy_since = None
+            expires = min(entry[3] for entry in pending)
+            wait([entry[0] for entry in pending], timeout=max(0.0, expires - time.monotonic()),
+                 return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            remaining = []
+            for entry in pending:
+                future, index, inp, deadline = entry
+                if future.done():
+                    try:
+                        yield {"index": index, "output": in_request_order(future.result(), inp)}
+                    except ValueError as e:
+                        yield {"index": index, "error": f"{tool}: {e}"}
+                    except Exception as e:
+                        yield {"index": index, "error": f"{tool} failed: {e}"}
+                elif now >= deadline:
+                    yield {"index": index, "error": f"{tool} timed out after {self.solve_timeout}s"}
+                else:
+                    remaining.append(entry)
+            pending = remaining
+
+    def _done(self, key, future, seconds):
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+        with self.lock:
+            self.inflight.pop(key, None)
+            self.solves += 1
+            self.solve_seconds += seconds
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "cache": self.cache.stats(),
+                "solver": {
+                    "workers": self.workers,
+                    "queue": self.queue_size,
+                    "in_flight": len(self.inflight),
+                    "solves": self.solves,
+                    "fast_solves": self.fast_solves,
+                    "coalesced": self.coalesced,
+                    "rejected": self.rejected,
+                    "avg_solve_seconds": self.solve_seconds / self.solves if self.solves else 0.0,
+                },
+            }
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+        self.cache.close()
+
+class MCPHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 で keep-alive（レスポンスには必ず Content-Length を付ける）
+    protocol_version = "HTTP/1.1"
+    # アイドルの keep-alive 接続を閉じるまでの秒数
+    timeout = 60
+    # ヘッダーと本文を別々に書くので、keep-alive で Nagle と遅延ACKが重なって応答が約40ms遅れるのを防ぐ
+    disable_nagle_algorithm = True
 
+    def send_json(self, status, resp, headers=None):
         body = json.dumps(resp).encode("utf-8")
-        self.send_response(200)
+        self.send_response(status)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", len(body))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
         self.end_headers()
         self.wfile.write(body)
 
+    def send_chunk(self, data):
+        """chunked 転送の1チャンクを書き出す"""
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+
+    def stream_batch(self, inp):
+        """シナリオのリストを並列に解き、終わった順に NDJSON（1行1シナリオ）で返す"""
+        scenarios = inp.get("scenarios") if isinstance(inp, dict) else None
+        if not isinstance(scenarios, list) or not all(isinstance(s, dict) for s in scenarios):
+            self.send_json(400, {"error": "optimize_blend_batch requires input.scenarios (list of objects)"})
+            return
+        # シナリオにない項目は input の値を使う（oils は共通で demand だけ振る場合など）
+        defaults = {k: v for k, v in inp.items() if k != "scenarios"}
+        scenarios = [{**defaults, **s} for s in scenarios]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        start = time.perf_counter()
+        errors = 0
+        try:
+            for line in self.server.solve_batch("optimize_blend", scenarios):
+                errors += "error" in line
+                self.send_chunk((json.dumps(line) + "\n").encode("utf-8"))
+            summary = {"done": True, "count": len(scenarios), "errors": errors,
+                       "seconds": round(time.perf_counter() - start, 4)}
+            self.send_chunk((json.dumps(summary) + "\n").encode("utf-8"))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが途中で切断した。解き終わった結果はキャッシュに残る
+            self.close_connection = True
+
+    def do_POST(self):
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(content_length)
+            req = json.loads(data or b"{}")
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        if not isinstance(req, dict):
+            self.send_json(400, {"error": "Invalid request: body must be a JSON object"})
+            return
+        tool = req.get("tool_id")
+        inp = req.get("input", {})
+
+        if tool == "stats":
+            self.send_json(200, {"output": self.server.stats()})
+            return
+        if tool == "optimize_blend_batch":
+            self.stream_batch(inp)
+            return
+        if tool not in self.server.solvers:
+            self.send_json(200, {"error": f"Unknown tool {tool}"})
+            return
+
+        future = self.server.solve(tool, inp)
+        if future is None:
+            self.send_json(503, {"error": "Server is busy"}, {"Retry-After": "1"})
+            return
+        try:
+            output = future.result(timeout=self.server.solve_timeout)
+        except FutureTimeoutError:
+            self.send_json(504, {"error": f"{tool} timed out after {self.server.solve_timeout}s"})
+            return
+        except ValueError as e:
+            # 入力の誤りや実行不能
+            self.send_json(422, {"error": f"{tool}: {e}"})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": f"{tool} failed: {e}"})
+            return
+        self.send_json(200, {"output": in_request_order(output, inp)})
+
+def in_request_order(output, inp):
+    """キャッシュのキーは油脂を名前順に並べるので、blend はリクエストの油脂の順に並べ直す"""
+    blend = output.get("blend")
+    if not isinstance(blend, dict):
+        return output
+    order = [o.get("name") for o in inp.get("oils", []) if isinstance(o, dict)]
+    ordered = {name: blend[name] for name in order if name in blend}
+    ordered.update({name: value for name, value in blend.items() if name not in ordered})
+    return {**output, "blend": ordered}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MCP blend optimizer server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="ソルバーを実行するプロセス数（既定: CPU数）")
+    parser.add_argument("--queue", type=int, default=None,
+                        help="実行待ちにできるジョブ数。超えると 503（既定: workers と同じ）")
+    parser.add_argument("--timeout", type=float, default=60, help="1回の最適化の待ち時間の上限（秒）")
+    parser.add_argument("--cache-size", type=int, default=1024, help="結果キャッシュの件数（0 で無効）")
+    parser.add_argument("--cache-file", default=None, help="結果キャッシュを保存するSQLiteファイル（省略時はメモリのみ）")
+    parser.add_argument("--cache-precision", type=int, default=6, help="キャッシュのキーで数値を丸める小数点以下の桁数")
+    parser.add_argument("--solver", choices=["auto", "model", "cbc"], default="auto",
+                        help="auto: 2制約のLPは高速解法、それ以外はテンプレート（HiGHS） / "
+                             "model: 常にテンプレート / cbc: 常に PuLP + CBC")
+    return parser.parse_args()
+
 def run():
-    server = HTTPServer(("0.0.0.0", 9100), MCPHandler)
-    print("MCP blend optimizer running on port 9100")
-    server.serve_forever()
+    args = parse_args()
+    queue_size = args.workers if args.queue is None else args.queue
+    cache = BlendCache(args.cache_size, args.cache_file, args.cache_precision)
+    server = BlendServer((args.host, args.port), args.workers, queue_size, args.timeout, cache,
+                         CBC_SOLVERS if args.solver == "cbc" else SOLVERS,
+                         FAST_SOLVERS if args.solver == "auto" else {})
+    # ワーカープロセスは起動時に立ち上げておく
+    for future in [server.pool.submit(_warm_up) for _ in range(args.workers)]:
+        future.result()
+    print(f"MCP blend optimizer running on port {args.port} (workers: {args.workers}, queue: {queue_size}, solver: {args.solver})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 if __name__ == "__main__":
     run()
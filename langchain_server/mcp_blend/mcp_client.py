@@ -0,0 +1,122 @@
+"""
+MCPサーバー（mcp_blend_server.py）の非同期クライアント
+
+1つの httpx.AsyncClient（コネクションプール）を使い回し、呼び出しごとの接続確立をなくします。
+
+- keep-alive: 接続は max_keepalive 本まで keepalive_expiry 秒残して再利用する
+- タイムアウト: 接続 connect_timeout 秒、応答 timeout 秒
+- リトライ: 接続エラー・タイムアウトと 502 / 503 / 504 は retries 回まで指数バックオフ（ジッター付き）で再送する。
+  503 の Retry-After があればその秒数を待つ（max_backoff 秒まで）。最適化は同じ入力なら同じ結果なので再送しても問題ない
+- invoke_many: 複数の呼び出しを max_connections 本の接続に並べて同時に送る
+- stream_batch: optimize_blend_batch で1リクエストにまとめ、NDJSON の結果を届いた順に返す
+
+    client = AsyncMCPClient("http://localhost:9100")
+    result = await client.invoke_tool("optimize_blend", {"oils": oils, "demand": 1000})
+    await client.aclose()
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+
+import httpx
+
+# 共通ライブラリ（langchain_server/lib）
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "lib"))
+import metrics
+
+RETRIES = metrics.REGISTRY.counter("mcp_client_retries_total", "MCP tool calls retried after a transport error or 502/503/504.")
+
+# 再送するステータス（ゲートウェイのエラー・混雑・ソルバーのタイムアウト）
+RETRY_STATUS = {502, 503, 504}
+
+
+class MCPError(Exception):
+    """MCPサーバーがエラーを返した"""
+
+
+class AsyncMCPClient:
+    def __init__(self, url, max_connections=10, max_keepalive=5, keepalive_expiry=30,
+                 timeout=60, connect_timeout=5, retries=3, backoff=0.5, max_backoff=8):
+        self.url = url
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+
+    def _delay(self, attempt, response=None):
+        """attempt 回目の再送までの秒数"""
+        if response is not None:
+            try:
+                # 大きな Retry-After で1回の呼び出しが止まり続けないよう max_backoff で切る
+                return min(self.max_backoff, max(0.0, float(response.headers["Retry-After"])))
+            except (KeyError, ValueError):
+                pass
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    async def _post(self, tool_id, payload):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.client.post(self.url, json=payload)
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                delay = self._delay(attempt)
+                reason = type(e).__name__
+            else:
+                if response.status_code not in RETRY_STATUS or attempt == self.retries:
+                    return response
+                delay = self._delay(attempt, response)
+                reason = str(response.status_code)
+            RETRIES.inc(tool=tool_id, reason=reason)
+            await asyncio.sleep(delay)
+
+    async def invoke_tool(self, tool_id, input_data):
+        """レスポンスの JSON（{"output": ...}）を返す。サーバーがエラーを返したら MCPError"""
+        response = await self._post(tool_id, {"tool_id": tool_id, "input": input_data})
+        try:
+            body = response.json()
+        except ValueError:
+            raise MCPError(f"{tool_id}: {response.status_code} {response.text[:200]}") from None
+        if "error" in body:
+            raise MCPError(body["error"])
+        return body
+
+    async def invoke_many(self, calls):
+        """(tool_id, input) のリストを接続を並べて同時に送り、結果を同じ順に返す"""
+        semaphore = asyncio.Semaphore(self.max_connections)
+
+        async def invoke(tool_id, input_data):
+            async with semaphore:
+                return await self.invoke_tool(tool_id, input_data)
+
+        return await asyncio.gather(*(invoke(tool_id, input_data) for tool_id, input_data in calls))
+
+    async def stream_batch(self, scenarios, **shared):
+        """optimize_blend_batch で解き、{"index", "output" または "error"} を終わった順に返す
+
+        shared はすべてのシナリオに共通の項目（oils など）。ストリームの途中では再送しない。
+        """
+        payload = {"tool_id": "optimize_blend_batch", "input": {**shared, "scenarios": scenarios}}
+        async with self.client.stream("POST", self.url, json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise MCPError(f"optimize_blend_batch: {response.status_code} {response.text[:200]}")
+            async for line in response.aiter_lines():
+                if line:
+                    record = json.loads(line)
+                    if "index" in record:
+                        yield record
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -8,16 +8,19 @@ LangChain Embedding 基本サンプル
 """
 
 import asyncio
+import os
 from typing import List
 import numpy as np
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain_core.documents import Document
 
 # ===== 設定 =====
+EMBEDDING_BASE_URL = os.getenv("EMBEDDING_BASE_URL", "http://localhost:11434")
+
 def get_embeddings():
     """Embedding モデルを取得"""
     return OllamaEmbeddings(
-        base_url="http://localhost:11434",
+        base_url=EMBEDDING_BASE_URL,
         model="mxbai-embed-large"  # Ollamaの軽量embedgingモデル
     )
 
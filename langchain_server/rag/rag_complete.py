@@ -9,6 +9,8 @@ LangChain RAG (Retrieval-Augmented Generation) 完全サンプル
 """
 
 import asyncio
+import os
+import time
 from typing import List
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain_openai import ChatOpenAI
@@ -18,19 +20,32 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from vector_index import index_settings, load_index, save_index, text_sources
 
 # ===== 設定 =====
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+EMBEDDING_BASE_URL = os.getenv("EMBEDDING_BASE_URL", "http://localhost:11434")
+EMBEDDING_MODEL = "mxbai-embed-large"
+# テキスト分割の設定（変えると保存済みのインデックスは作り直す）
+SPLITTER_SETTINGS = {
+    "chunk_size": 200,
+    "chunk_overlap": 50,
+    "separators": ["\n\n", "\n", "。", "、", " ", ""],
+}
+# 保存するインデックスの名前（vector_index.py）
+INDEX_NAME = "complete"
+
 def get_embeddings():
     """Embedding モデルを取得"""
     return OllamaEmbeddings(
-        base_url="http://localhost:11434",
-        model="mxbai-embed-large"
+        base_url=EMBEDDING_BASE_URL,
+        model=EMBEDDING_MODEL
     )
 
 def get_llm():
     """LLMモデルを取得"""
     return ChatOpenAI(
-        openai_api_base="http://localhost:11434/v1",
+        openai_api_base=OLLAMA_BASE_URL,
         temperature=0.7,
         openai_api_key="EMPTY",
         model="qwen3:8b"
@@ -87,6 +102,15 @@ async def build_vector_store():
     print("1️⃣  ベクトルストアの構築")
     print("="*70)
     
+    # Embeddingモデル
+    embeddings = get_embeddings()
+    
+    # 保存済みのインデックスがあれば、ベクトル化せずに開く
+    settings = index_settings(EMBEDDING_MODEL, SPLITTER_SETTINGS, text_sources(SAMPLE_DOCUMENTS))
+    vectorstore = load_index(INDEX_NAME, settings, embeddings)
+    if vectorstore is not None:
+        return vectorstore
+    
     # ドキュメントオブジェクトの作成
     documents = [
         Document(page_content=text.strip(), metadata={"source": f"doc_{i}"})
@@ -96,23 +120,21 @@ async def build_vector_store():
     print(f"📚 ドキュメント数: {len(documents)}")
     
     # テキスト分割器
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=200,
-        chunk_overlap=50,
-        separators=["\n\n", "\n", "。", "、", " ", ""]
-    )
+    text_splitter = RecursiveCharacterTextSplitter(**SPLITTER_SETTINGS)
     
     # ドキュメントを分割
     splits = text_splitter.split_documents(documents)
     print(f"📄 分割後のチャンク数: {len(splits)}")
     
-    # Embeddingモデル
-    embeddings = get_embeddings()
-    
     # ベクトルストアの作成
     print("🔄 ベクトル化中...")
+    start = time.perf_counter()
     vectorstore = await FAISS.afrom_documents(splits, embeddings)
-    print("✅ ベクトルストア構築完了")
+    build_seconds = time.perf_counter() - start
+    print(f"✅ ベクトルストア構築完了（{build_seconds:.1f}秒）")
+    
+    # 次回の起動のために保存
+    save_index(INDEX_NAME, vectorstore, settings, build_seconds)
     
     return vectorstore
 
@@ -243,7 +265,7 @@ async def streaming_rag_demo(vectorstore):
     
     # ストリーミング用LLM
     streaming_llm = ChatOpenAI(
-        openai_api_base="http://localhost:11434/v1",
+        openai_api_base=OLLAMA_BASE_URL,
         streaming=True,
         temperature=0.7,
         openai_api_key="EMPTY",
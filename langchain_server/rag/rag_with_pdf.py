@@ -10,6 +10,7 @@ LangChain RAG with PDF - PDFドキュメントを使用したRAGシステム
 
 import asyncio
 import os
+import time
 from pathlib import Path
 from typing import List
 from langchain_community.embeddings import OllamaEmbeddings
@@ -21,21 +22,33 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from vector_index import file_sources, index_settings, load_index, save_index
 
 # ===== 設定 =====
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+EMBEDDING_BASE_URL = os.getenv("EMBEDDING_BASE_URL", "http://localhost:11434")
+EMBEDDING_MODEL = "kun432/cl-nagoya-ruri-large"
+# EMBEDDING_MODEL = "mxbai-embed-large"
+# テキスト分割の設定（変えると保存済みのインデックスは作り直す）
+SPLITTER_SETTINGS = {
+    "chunk_size": 500,
+    "chunk_overlap": 100,
+    "separators": ["\n\n", "\n", "。", ". ", " "],
+}
+# 保存するインデックスの名前（vector_index.py）
+INDEX_NAME = "pdf"
+
 def get_embeddings():
     """Embedding モデルを取得"""
     return OllamaEmbeddings(
-        base_url="http://localhost:11434",
-        model="kun432/cl-nagoya-ruri-large"
+        base_url=EMBEDDING_BASE_URL,
+        model=EMBEDDING_MODEL
     )
-        # model="kun432/cl-nagoya-ruri-large"
-        # model="mxbai-embed-large"
 
 def get_llm(streaming: bool = False):
     """LLMモデルを取得"""
     return ChatOpenAI(
-        openai_api_base="http://localhost:11434/v1",
+        openai_api_base=OLLAMA_BASE_URL,
         streaming=streaming,
         temperature=0.3,
         openai_api_key="EMPTY",
@@ -222,8 +235,11 @@ async def load_pdf_directory():
         return []
 
 # ===== 3. PDFからベクトルストアを構築 =====
-async def build_vectorstore_from_pdf(documents):
-    """PDFドキュメントからベクトルストアを構築"""
+async def build_vectorstore_from_pdf(documents, settings=None):
+    """PDFドキュメントからベクトルストアを構築
+
+    settings（pdf_index_settings()）を渡すとインデックスを保存する。PDFを読み込む前に取得したものを渡す。
+    """
     print("\n" + "="*70)
     print("3️⃣  ベクトルストアの構築")
     print("="*70)
@@ -233,11 +249,7 @@ async def build_vectorstore_from_pdf(documents):
         return None
     
     # テキスト分割器
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=100,
-        separators=["\n\n", "\n", "。", ". ", " "]
-    )
+    text_splitter = RecursiveCharacterTextSplitter(**SPLITTER_SETTINGS)
     
     # ドキュメントを分割
     print(f"📄 元のページ数: {len(documents)}")
@@ -256,11 +268,28 @@ async def build_vectorstore_from_pdf(documents):
     
     # ベクトルストアの作成
     print("\n🔄 ベクトル化中...")
+    start = time.perf_counter()
     vectorstore = await FAISS.afrom_documents(splits, embeddings)
-    print("✅ ベクトルストア構築完了")
+    build_seconds = time.perf_counter() - start
+    print(f"✅ ベクトルストア構築完了（{build_seconds:.1f}秒）")
+    
+    # 次回の起動のために保存
+    if settings is not None:
+        save_index(INDEX_NAME, vectorstore, settings, build_seconds)
     
     return vectorstore
 
+def pdf_index_settings():
+    """保存済みのインデックスを使えるかを判定する設定（PDFはファイルのサイズと更新時刻で比べる）"""
+    return index_settings(EMBEDDING_MODEL, SPLITTER_SETTINGS, file_sources(PDF_DIR.glob("*.pdf")))
+
+def load_saved_vectorstore(settings):
+    """保存済みのインデックスを開く。使えなければ None"""
+    print("\n" + "="*70)
+    print("💾 保存済みインデックスの確認")
+    print("="*70)
+    return load_index(INDEX_NAME, settings, get_embeddings())
+
 # ===== 4. PDFベースのRAG質問応答 =====
 async def pdf_rag_qa(vectorstore):
     """PDFベースのRAG質問応答システム"""
@@ -463,15 +492,26 @@ async def main():
     print("LangChain RAG with PDF")
     print("🌟"*35)
     
-    # PDFドキュメントの読み込み
-    documents = await load_pdf_documents()
+    # PDFの一覧は読み込む前に記録する（構築中に変わったPDFは、次の起動で作り直す）
+    settings = pdf_index_settings()
     
-    if not documents:
-        print("\n❌ PDFファイルを読み込めませんでした")
-        return
+    # 保存済みのインデックスがあれば、PDFの読み込みとベクトル化を省く
+    vectorstore = load_saved_vectorstore(settings)
     
-    # ベクトルストアの構築
-    vectorstore = await build_vectorstore_from_pdf(documents)
+    if vectorstore is None:
+        # PDFドキュメントの読み込み
+        documents = await load_pdf_documents()
+        
+        if not documents:
+            print("\n❌ PDFファイルを読み込めませんでした")
+            return
+        
+        # PDFがなくサンプルPDFを作成したときは、その一覧にする
+        if not settings["sources"]:
+            settings = pdf_index_settings()
+        
+        # ベクトルストアの構築
+        vectorstore = await build_vectorstore_from_pdf(documents, settings)
     
     if not vectorstore:
         print("\n❌ ベクトルストアを構築できませんでした")
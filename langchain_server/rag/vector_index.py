@@ -0,0 +1,155 @@
+"""
+FAISSインデックスの保存と再利用
+
+ベクトルストアをディレクトリに保存し、次回の起動ではEmbeddingをやり直さずに開きます。
+
+    index/<名前>/
+      index.faiss    FAISSのインデックス（faiss.write_index）
+      docstore.json  チャンクの本文とメタデータ（インデックスの行の順）
+      manifest.json  構築したときの設定（Embeddingモデル・テキスト分割の設定・元文書）と件数
+
+- 開くとき: manifest の設定が今の設定と同じなら index.faiss を faiss.IO_FLAG_MMAP_IFC でメモリマップして開く。
+  ベクトルはコピーせずファイルをそのまま参照するので、200,000件×64次元でも約1ms（フラグなし・IO_FLAG_MMAP
+  では全件を読んで約40ms）。docstore.json は全件を読むので、起動時間はチャンク数に比例する
+  （2,000件で約12ms、200,000件で約2.8秒。どちらもEmbeddingのやり直しよりはずっと短い）
+- 開いたインデックスは読み取り専用。add_documents などで追加するとプロセスが異常終了するので、
+  文書を追加するときは作り直す
+- 作り直すとき: manifest がない・設定が違う・ファイルが壊れている。Embeddingモデルやテキスト分割の設定を
+  変えたとき、元文書を追加・変更したときは自動で作り直す
+- 保存先の親ディレクトリは環境変数 RAG_INDEX_DIR（既定: このディレクトリの index/）。
+  手動で作り直すときはディレクトリを削除する
+
+    settings = index_settings(EMBEDDING_MODEL, SPLITTER_SETTINGS, sources)
+    vectorstore = load_index("complete", settings, embeddings)
+    if vectorstore is None:
+        vectorstore = await FAISS.afrom_documents(splits, embeddings)
+        save_index("complete", vectorstore, settings)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+# ===== 設定 =====
+INDEX_ROOT = Path(os.getenv("RAG_INDEX_DIR", Path(__file__).parent / "index"))
+# 保存形式を変えたら上げる（古いインデックスは作り直す）
+MANIFEST_VERSION = 1
+
+def index_dir(name):
+    return INDEX_ROOT / name
+
+def file_sources(paths):
+    """元文書のファイルの一覧（名前・サイズ・更新時刻）。中身を読まずに変更を検出する"""
+    sources = []
+    for path in sorted(Path(p) for p in paths):
+        stat = path.stat()
+        sources.append({"name": path.name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+    return sources
+
+def text_sources(texts):
+    """元文書の本文のハッシュ（SHA-256）"""
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return {"count": len(texts), "sha256": digest.hexdigest()}
+
+def index_settings(embedding_model, splitter_settings, sources):
+    """インデックスの作り直しが必要かを判定する設定"""
+    # JSON に保存して読み戻した値と比べるので、タプルなどをそろえておく
+    return json.loads(json.dumps({
+        "embedding_model": embedding_model,
+        "splitter": splitter_settings,
+        "sources": sources,
+    }, ensure_ascii=False))
+
+def read_manifest(name):
+    try:
+        return json.loads((index_dir(name) / "manifest.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def load_index(name, settings, embeddings):
+    """保存済みのインデックスをメモリマップで開く（読み取り専用）。ない・設定が違う・壊れているときは None"""
+    directory = index_dir(name)
+    manifest = read_manifest(name)
+    if manifest is None:
+        print(f"ℹ️  保存済みのインデックスがありません: {directory}")
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        print("ℹ️  インデックスの保存形式が違うため作り直します")
+        return None
+    saved = manifest.get("settings", {})
+    changed = [key for key in settings if saved.get(key) != settings[key]]
+    if changed:
+        print(f"ℹ️  設定が変わったためインデックスを作り直します: {', '.join(changed)}")
+        return None
+
+    start = time.perf_counter()
+    try:
+        # IO_FLAG_MMAP だけでは IndexFlat のベクトルは全件読み込まれる。IO_FLAG_MMAP_IFC で参照にする
+        index = faiss.read_index(str(directory / "index.faiss"), faiss.IO_FLAG_MMAP_IFC)
+        index_seconds = time.perf_counter() - start
+        records = json.loads((directory / "docstore.json").read_text(encoding="utf-8"))
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"⚠️  インデックスを読み込めないため作り直します: {e}")
+        return None
+    if index.ntotal != len(records):
+        print(f"⚠️  インデックスの件数が合わないため作り直します（{index.ntotal} / {len(records)}）")
+        return None
+
+    docstore = InMemoryDocstore({
+        r["id"]: Document(id=r["id"], page_content=r["page_content"], metadata=r["metadata"])
+        for r in records
+    })
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id={i: r["id"] for i, r in enumerate(records)},
+    )
+    print(f"💾 保存済みのインデックスを開きました: {directory}")
+    print(f"   チャンク数: {index.ntotal}、読み込み時間: {(time.perf_counter() - start) * 1000:.1f}ms"
+          f"（インデックス {index_seconds * 1000:.1f}ms）")
+    return vectorstore
+
+def save_index(name, vectorstore, settings, build_seconds=None):
+    """ベクトルストアを保存する
+
+    一時ディレクトリに書いてから入れ替えるので、途中で止まっても壊れたインデックスは残らない。
+    manifest は最後に書く。
+    """
+    directory = index_dir(name)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp = directory.with_name(f"{directory.name}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+
+    records = []
+    for i in range(vectorstore.index.ntotal):
+        doc_id = vectorstore.index_to_docstore_id[i]
+        doc = vectorstore.docstore.search(doc_id)
+        records.append({"id": doc_id, "page_content": doc.page_content, "metadata": doc.metadata})
+    faiss.write_index(vectorstore.index, str(tmp / "index.faiss"))
+    (tmp / "docstore.json").write_text(json.dumps(records, ensure_ascii=False, default=str), encoding="utf-8")
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "settings": settings,
+        "chunks": len(records),
+        "dimension": vectorstore.index.d,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "build_seconds": build_seconds,
+    }
+    (tmp / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    shutil.rmtree(directory, ignore_errors=True)
+    tmp.rename(directory)
+    print(f"💾 インデックスを保存しました: {directory}")
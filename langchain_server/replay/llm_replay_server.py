@@ -0,0 +1,193 @@
+"""
+Ollama（OpenAI互換API・Ollama API）の代わりに動く記録・再生サーバー
+
+record: 受けたリクエストを --upstream（Ollama）へ転送し、リクエストとレスポンスの組を記録する
+replay: 記録したレスポンスを返す。Ollama は使わず、待ち時間は --latency などで指定した値にする
+
+    python llm_replay_server.py record --upstream http://localhost:11434 --port 11435
+    python llm_replay_server.py replay --latency 0.5 --chunk-latency 0.02 --port 11435
+
+アプリの接続先を http://localhost:11435/v1（Embedding は http://localhost:11435）に向けて使います。
+/replay/stats で再生した件数・記録がなかった件数・わざと待たせた時間の合計を返します。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# 共通ライブラリ（langchain_server/lib）
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+import metrics
+from recording import Recording, canonical, make_key
+
+REQUESTS = metrics.REGISTRY.counter('replay_requests_total', 'Requests served by the replay server by result (recorded, hit, miss).')
+INJECTED = metrics.REGISTRY.counter('replay_injected_latency_seconds_total', 'Synthetic latency added to replayed responses.')
+
+# ストリーミングのレスポンスはイベント単位で送り直す
+STREAM_SEPARATORS = {'text/event-stream': '\n\n', 'application/x-ndjson': '\n'}
+
+args = None
+recording: Recording = None
+client: httpx.AsyncClient = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    if args.mode == 'record':
+        client = httpx.AsyncClient(base_url=args.upstream, timeout=httpx.Timeout(None, connect=5))
+    yield
+    if client is not None:
+        await client.aclose()
+    recording.close()
+
+
+app = FastAPI(title='LLM record/replay server', lifespan=lifespan)
+metrics.install(app)
+
+
+def request_key(method: str, path: str, query: str, body: bytes) -> str:
+    """メソッド・パス・クエリと本文（JSONはキー順をそろえる）から記録のキーを作る"""
+    try:
+        text = canonical(json.loads(body)) if body else ''
+    except ValueError:
+        text = body.decode('utf-8', 'replace')
+    return make_key(method, path, query, text)
+
+
+def stream_separator(content_type: str):
+    for media_type, separator in STREAM_SEPARATORS.items():
+        if content_type.startswith(media_type):
+            return separator
+    return None
+
+
+async def inject(seconds: float):
+    """合成の待ち時間を入れて合計に数える"""
+    if seconds > 0:
+        INJECTED.inc(seconds)
+        await asyncio.sleep(seconds)
+
+
+async def record(request: Request, path: str, key: str, body: bytes):
+    start = time.perf_counter()
+    upstream = client.build_request(
+        request.method, path, params=request.query_params, content=body,
+        headers={'content-type': request.headers.get('content-type', 'application/json')})
+    response = await client.send(upstream, stream=True)
+    content_type = response.headers.get('content-type', 'application/json')
+    entry = {'key': key, 'method': request.method, 'path': path, 'query': str(request.query_params),
+             'request': body.decode('utf-8', 'replace'), 'status': response.status_code, 'content_type': content_type}
+    # 5xx（Ollama の一時的なエラー）は記録しない
+    keep = response.status_code < 500
+
+    if stream_separator(content_type) is not None:
+        async def relay():
+            chunks = []
+            try:
+                async for text in response.aiter_text():
+                    chunks.append([round(time.perf_counter() - start, 4), text])
+                    yield text
+            finally:
+                await response.aclose()
+            if keep:
+                recording.append({**entry, 'chunks': chunks, 'duration': round(time.perf_counter() - start, 4)})
+                REQUESTS.inc(result='recorded')
+
+        return StreamingResponse(relay(), status_code=response.status_code, media_type=content_type)
+
+    content = await response.aread()
+    await response.aclose()
+    if keep:
+        recording.append({**entry, 'body': content.decode('utf-8', 'replace'), 'duration': round(time.perf_counter() - start, 4)})
+        REQUESTS.inc(result='recorded')
+    return Response(content=content, status_code=response.status_code, media_type=content_type)
+
+
+async def replay(path: str, key: str):
+    entry = recording.next(key)
+    if entry is None:
+        REQUESTS.inc(result='miss')
+        print(f'[replay] 記録がありません: {path} {key[:12]}', file=sys.stderr)
+        return JSONResponse({'error': {'message': f'no recording for {path}', 'type': 'replay_miss', 'key': key}},
+                            status_code=404)
+    REQUESTS.inc(result='hit')
+    content_type = entry['content_type']
+
+    if 'chunks' in entry:
+        async def stream():
+            if args.latency_scale is not None:
+                # 記録したときのタイミングを latency_scale 倍して再現する
+                elapsed = 0.0
+                for offset, text in entry['chunks']:
+                    await inject(offset * args.latency_scale - elapsed)
+                    elapsed = max(elapsed, offset * args.latency_scale)
+                    yield text
+                return
+            separator = stream_separator(content_type)
+            events = [event + separator for event in ''.join(text for _, text in entry['chunks']).split(separator) if event]
+            await inject(args.latency)
+            for i, event in enumerate(events):
+                if i:
+                    await inject(args.chunk_latency)
+                yield event
+
+        return StreamingResponse(stream(), status_code=entry['status'], media_type=content_type)
+
+    if args.latency_scale is not None:
+        await inject(entry['duration'] * args.latency_scale)
+    else:
+        await inject(args.latency)
+    return Response(content=entry['body'], status_code=entry['status'], media_type=content_type)
+
+
+@app.get('/replay/stats')
+async def replay_stats():
+    return {
+        'mode': args.mode,
+        'recordings': len(recording),
+        'recorded': REQUESTS.value(result='recorded'),
+        'hits': REQUESTS.value(result='hit'),
+        'misses': REQUESTS.value(result='miss'),
+        'injected_seconds': round(INJECTED.value(), 4),
+    }
+
+
+@app.api_route('/{path:path}', methods=['GET', 'POST'])
+async def handle(path: str, request: Request):
+    body = await request.body()
+    path = '/' + path
+    key = request_key(request.method, path, str(request.query_params), body)
+    if args.mode == 'record':
+        return await record(request, path, key, body)
+    return await replay(path, key)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='LLM（Ollama）の記録・再生サーバー')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('--recordings', default='recordings', help='記録のディレクトリ（llm.jsonl に保存する）')
+    parser.add_argument('--upstream', default='http://localhost:11434', help='record で転送する Ollama のURL')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--latency', type=float, default=0.0, help='replay: 最初の応答までの待ち時間（秒）')
+    parser.add_argument('--chunk-latency', type=float, default=0.0, help='replay: ストリーミングのイベント間の待ち時間（秒）')
+    parser.add_argument('--latency-scale', type=float, default=None,
+                        help='replay: 指定すると記録したときの所要時間をこの倍率で再現する（--latency より優先）')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    recording = Recording(os.path.join(args.recordings, 'llm.jsonl'))
+    print(f'[replay] {args.mode}: {recording.path} ({len(recording)}件)', file=sys.stderr)
+    uvicorn.run(app, host=args.host, port=args.port)
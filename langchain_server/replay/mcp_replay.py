@@ -0,0 +1,184 @@
+"""
+stdio のMCPサーバーの記録・再生
+
+record: 本物のMCPサーバー（java -jar ...）を子プロセスとして起動して JSON-RPC を中継し、
+        リクエストとレスポンスの組を記録する
+replay: 記録したレスポンスを返す偽のMCPサーバーとして動く。Java もチェックリストのサーバーも使わない
+
+mcp_servers の command / args をこのスクリプトに置き換えて使います。
+
+    "command": "python",
+    "args": ["../replay/mcp_replay.py", "record", "--file", "recordings/mcp-checklist.jsonl",
+             "--", "java", "-jar", "./sandbox-mcp-checklist-0.0.1-SNAPSHOT-all.jar", "--type", "3"]
+
+    "args": ["../replay/mcp_replay.py", "replay", "--file", "recordings/mcp-checklist.jsonl",
+             "--latency", "0.05", "--startup-latency", "1.5"]
+
+ツール呼び出しは名前と引数で引き、記録がない呼び出しには isError のツール結果を返します。
+終了時に再生した件数・記録がなかった件数・わざと待たせた時間を標準エラーに出力します。
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from recording import Recording, canonical, make_key
+
+_write_lock = threading.Lock()
+
+
+def request_key(method: str, params) -> str:
+    """JSON-RPC の id と _meta（progressToken など）を除いたメソッドと引数からキーを作る"""
+    if method == 'initialize':
+        # クライアントの情報（バージョンなど）によらず同じ応答を返す
+        return make_key(method)
+    params = {k: v for k, v in (params or {}).items() if k != '_meta'}
+    return make_key(method, canonical(params))
+
+
+def write_message(stream, message: dict):
+    with _write_lock:
+        stream.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+        stream.flush()
+
+
+def record(args):
+    recording = Recording(args.file)
+    child = subprocess.Popen(args.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    pending = {}
+    pending_lock = threading.Lock()
+
+    def client_to_server():
+        for line in sys.stdin.buffer:
+            try:
+                message = json.loads(line)
+                if 'method' in message and 'id' in message:
+                    with pending_lock:
+                        pending[message['id']] = (message['method'], message.get('params'), time.perf_counter())
+            except ValueError:
+                pass
+            child.stdin.write(line)
+            child.stdin.flush()
+        child.stdin.close()
+
+    threading.Thread(target=client_to_server, daemon=True).start()
+    for line in child.stdout:
+        sys.stdout.buffer.write(line)
+        sys.stdout.buffer.flush()
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if 'method' in message or 'id' not in message:
+            continue
+        with pending_lock:
+            request = pending.pop(message['id'], None)
+        if request is None:
+            continue
+        method, params, start = request
+        entry = {'key': request_key(method, params), 'method': method, 'params': params,
+                 'duration': round(time.perf_counter() - start, 4)}
+        entry.update({'error': message['error']} if 'error' in message else {'result': message.get('result')})
+        recording.append(entry)
+    recording.close()
+    return child.wait()
+
+
+class Replayer:
+    def __init__(self, args):
+        self.args = args
+        self.recording = Recording(args.file)
+        self.hits = 0
+        self.misses = 0
+        self.injected = 0.0
+        self._lock = threading.Lock()
+
+    def latency(self, method: str, entry) -> float:
+        if method != 'tools/call':
+            return 0.0
+        if self.args.latency_scale is not None and entry is not None:
+            return entry['duration'] * self.args.latency_scale
+        return self.args.latency
+
+    def respond(self, message: dict):
+        method = message['method']
+        params = message.get('params')
+        entry = None if method == 'ping' else self.recording.next(request_key(method, params))
+        delay = self.latency(method, entry)
+        if delay > 0:
+            time.sleep(delay)
+
+        response = {'jsonrpc': '2.0', 'id': message['id']}
+        if method == 'ping':
+            response['result'] = {}
+        elif entry is not None:
+            response.update({'error': entry['error']} if 'error' in entry else {'result': entry['result']})
+        elif method == 'initialize':
+            response['result'] = {
+                'protocolVersion': (params or {}).get('protocolVersion', '2025-06-18'),
+                'capabilities': {'tools': {}},
+                'serverInfo': {'name': 'mcp-replay', 'version': '0.1.0'},
+            }
+        elif method == 'tools/call':
+            response['result'] = {
+                'content': [{'type': 'text', 'text': f'replay: no recording for {params.get("name")} {canonical(params.get("arguments") or {})}'}],
+                'isError': True,
+            }
+        else:
+            response['error'] = {'code': -32601, 'message': f'replay: no recording for {method}'}
+
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+            elif method != 'ping':
+                self.misses += 1
+                print(f'[mcp-replay] 記録がありません: {method} {canonical(params or {})[:200]}', file=sys.stderr)
+            self.injected += delay
+        write_message(sys.stdout.buffer, response)
+
+    def run(self) -> int:
+        # MCPサーバー（JVM）の起動時間の代わり
+        if self.args.startup_latency > 0:
+            time.sleep(self.args.startup_latency)
+        threads = []
+        for line in sys.stdin.buffer:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if 'method' not in message or 'id' not in message:
+                continue  # 通知とクライアントからの応答には返さない
+            # 待ち時間を入れても他のリクエストを止めないよう1件ずつスレッドで返す
+            thread = threading.Thread(target=self.respond, args=(message,), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        print(f'[mcp-replay] 再生 {self.hits}件 記録なし {self.misses}件 待ち時間 {self.injected:.3f}秒', file=sys.stderr)
+        return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='stdio のMCPサーバーの記録・再生')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('--file', required=True, help='記録ファイル（JSON Lines）')
+    parser.add_argument('--latency', type=float, default=0.0, help='replay: ツール呼び出し1回の待ち時間（秒）')
+    parser.add_argument('--latency-scale', type=float, default=None,
+                        help='replay: 指定すると記録したときの所要時間をこの倍率で再現する（--latency より優先）')
+    parser.add_argument('--startup-latency', type=float, default=0.0, help='replay: 起動時の待ち時間（秒）')
+    argv = sys.argv[1:] if argv is None else argv
+    # -- より後ろは本物のMCPサーバーの起動コマンド（record）
+    command = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+    args.command = command
+    if args.mode == 'record' and not args.command:
+        parser.error('record には -- の後にMCPサーバーの起動コマンドが必要です')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    sys.exit(record(args) if args.mode == 'record' else Replayer(args).run())
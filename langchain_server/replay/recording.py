@@ -0,0 +1,68 @@
+"""
+記録したリクエストとレスポンスの組（JSON Lines）の読み書き
+
+1行が1組で、key（リクエストの正規化したハッシュ）で引きます。同じ key が複数回記録されている場合
+（同じ引数で呼んだツールの結果が更新の前後で変わる場合など）は記録した順に返し、尽きたら最後のものを返します。
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+
+def canonical(data) -> str:
+    """キーの順序や空白によらない JSON 文字列"""
+    return json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+def make_key(*parts: str) -> str:
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class Recording:
+    """1つの JSON Lines ファイルに記録したやり取り"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, List[dict]] = defaultdict(list)
+        self._next: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._file = None
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry['key']].append(entry)
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self.entries.values())
+
+    def next(self, key: str) -> Optional[dict]:
+        """key の次の記録（なければ None）"""
+        with self._lock:
+            entries = self.entries.get(key)
+            if not entries:
+                return None
+            index = self._next[key]
+            self._next[key] = index + 1
+            return entries[min(index, len(entries) - 1)]
+
+    def append(self, entry: dict):
+        """記録を追加してすぐにファイルへ書き出す"""
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self.entries[entry['key']].append(entry)
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
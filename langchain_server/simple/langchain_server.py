@@ -1,39 +1,323 @@
-from fastapi import FastAPI, Request
-from langchain_openai import ChatOpenAI
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from langchain_core.messages import HumanMessage
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
 import uvicorn
 
+# 共通ライブラリ（langchain_server/lib）
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "lib"))
+import metrics
+import token_counter
+from micro_batcher import MicroBatcher
+from model_router import ModelRouter
+from response_cache import ExactCache, ResponseCache, SemanticCache
+
 # Simpleserver to expose a local LLM via OpenAI-compatible API
 
-app = FastAPI()
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+
+# 同時実行数の上限と待ち行列の設定
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "4"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "16"))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "30"))
+RETRY_AFTER = int(os.getenv("RETRY_AFTER", "5"))
+
+# マイクロバッチの設定（既定は無効）
+BATCH_ENABLED = os.getenv("BATCH_ENABLED", "false").lower() == "true"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+# クライアントごとのトークンレート制限（0 なら無効）
+TOKEN_RATE_LIMIT_PER_MINUTE = float(os.getenv("TOKEN_RATE_LIMIT_PER_MINUTE", "0"))
+TOKEN_RATE_LIMIT_BURST = os.getenv("TOKEN_RATE_LIMIT_BURST")
+# X-Client-Id / Authorization ヘッダーでクライアントを識別する（信頼できるプロキシの後ろでだけ有効にする）
+TRUST_CLIENT_ID_HEADER = os.getenv("TRUST_CLIENT_ID_HEADER", "false").lower() == "true"
+
+# モデルバックエンドの定義ファイル
+MODELS_CONFIG = os.getenv("MODELS_CONFIG", os.path.join(os.path.dirname(__file__), "models.json"))
+
+# レスポンスキャッシュの設定
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", os.path.join(os.path.dirname(__file__), "cache", "semantic_cache.db"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+EMBEDDING_BASE_URL = os.getenv("EMBEDDING_BASE_URL", "http://localhost:11434")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "mxbai-embed-large")
 
-# 例: ローカルLLM (Ollamaなど) に接続
-llm = ChatOpenAI(
-    openai_api_base="http://localhost:11434/v1",  # Ollama
-    openai_api_key="none",
-    model="qwen3:4b"
+# 例: ローカルLLM (Ollamaなど) に接続。models.json がなければ環境変数の単一モデルを使う
+if os.path.exists(MODELS_CONFIG):
+    router = ModelRouter.from_file(MODELS_CONFIG)
+else:
+    router = ModelRouter.from_env()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # トークン数を数えるエンコーダーは最初のリクエストの前に取得しておく（初回はダウンロードが起きうる）
+    await token_counter.warm_up(b.model for b in router.backends.values())
+    yield
+    await router.aclose()
+
+app = FastAPI(lifespan=lifespan)
+metrics.install(app)
+
+LLM_TTFT = metrics.REGISTRY.histogram(
+    "llm_time_to_first_token_seconds", "Time from request to the first streamed token.",
+    buckets=[0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0],
 )
+CACHE_LOOKUPS = metrics.REGISTRY.counter("response_cache_lookups_total", "Response cache lookups by result.")
+
+class ConcurrencyLimiter:
+    """LLM呼び出しの同時実行数と待ち行列の長さを制限する"""
+
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout: float, retry_after: int):
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.waiting = 0
+
+    def _reject(self, status_code: int, detail: str) -> HTTPException:
+        return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    async def acquire(self):
+        if not self._semaphore.locked():
+            # 空きがあればその場で確保する（待たないので中断されない）
+            await self._semaphore.acquire()
+            self.in_flight += 1
+            return
+        # 空きがなく待ち行列も満杯なら、モデルの後ろに積まずにすぐ断る
+        if self.waiting >= self.max_queued:
+            raise self._reject(429, "Too many requests: queue is full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._reject(503, "Server busy: timed out waiting for a free slot")
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+limiter = ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS, QUEUE_TIMEOUT, RETRY_AFTER)
+
+token_limiter = None
+if TOKEN_RATE_LIMIT_PER_MINUTE > 0:
+    token_limiter = token_counter.TokenRateLimiter(
+        TOKEN_RATE_LIMIT_PER_MINUTE, float(TOKEN_RATE_LIMIT_BURST) if TOKEN_RATE_LIMIT_BURST else None
+    )
+
+batcher = MicroBatcher(BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS / 1000, BATCH_MAX_CONCURRENCY, limiter) if BATCH_ENABLED else None
+
+def create_response_cache():
+    """設定に従ってレスポンスキャッシュを作成（無効なら None）"""
+    if not CACHE_ENABLED:
+        return None
+    semantic = None
+    if SEMANTIC_CACHE_ENABLED:
+        from langchain_community.embeddings import OllamaEmbeddings
+        embeddings = OllamaEmbeddings(base_url=EMBEDDING_BASE_URL, model=EMBEDDING_MODEL)
+        semantic = SemanticCache(
+            SEMANTIC_CACHE_PATH, embeddings, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD
+        )
+    return ResponseCache(ExactCache(CACHE_MAX_ENTRIES, CACHE_TTL), semantic)
+
+response_cache = create_response_cache()
+
+def cache_bypassed(request: Request) -> bool:
+    """X-Cache-Bypass ヘッダーが指定されていればキャッシュを読まない（結果は保存する）"""
+    return request.headers.get("x-cache-bypass", "").lower() in ("1", "true", "yes")
+
+def sse_event(data) -> str:
+    """SSEの1イベント分の文字列を作成"""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    return f"data: {data}\n\n"
+
+def make_chunk(completion_id: str, created: int, model: str, delta: dict, finish_reason=None) -> dict:
+    """OpenAI形式の chat.completion.chunk を作成"""
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+async def stream_completion(replica, messages: list, model: str, on_complete=None):
+    """llm.astream の出力を chat.completion.chunk のSSEとして送出する
+
+    呼び出し側で limiter.acquire() と replica の確保が済んでいること。送信完了時に両方を解放する。
+    on_complete を指定すると、最後まで送信できた回答全文を渡して呼び出す。
+    """
+    try:
+        async for event in _stream_chunks(replica.llm, messages, model, on_complete):
+            yield event
+    finally:
+        replica.release()
+        limiter.release()
+
+async def stream_cached(content: str, model: str):
+    """キャッシュ済みの回答を1チャンクのSSEとして送出する"""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
+    yield sse_event(make_chunk(completion_id, created, model, {"role": "assistant"}))
+    yield sse_event(make_chunk(completion_id, created, model, {"content": content}))
+    yield sse_event(make_chunk(completion_id, created, model, {}, finish_reason="stop"))
+    yield sse_event("[DONE]")
+
+async def _stream_chunks(llm, messages: list, model: str, on_complete=None):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
+    start = time.perf_counter()
+    ttft = None
+    chunks = 0
+    parts = []
+
+    yield sse_event(make_chunk(completion_id, created, model, {"role": "assistant"}))
+    async for chunk in llm.astream(messages):
+        if not chunk.content:
+            continue
+        if ttft is None:
+            # 最初のトークンが届くまでの時間（ユーザーが体感する待ち時間）
+            ttft = time.perf_counter() - start
+            LLM_TTFT.observe(ttft, model=model)
+        chunks += 1
+        parts.append(chunk.content)
+        yield sse_event(make_chunk(completion_id, created, model, {"content": chunk.content}))
+    yield sse_event(make_chunk(completion_id, created, model, {}, finish_reason="stop"))
+    yield sse_event("[DONE]")
+
+    total = time.perf_counter() - start
+    metrics.STAGE_LATENCY.observe(total, stage="llm", model=model)
+    ttft_text = f"{ttft:.3f}s" if ttft is not None else "-"
+    print(f"[stream] {completion_id} ttft={ttft_text} total={total:.3f}s chunks={chunks}")
+    if on_complete is not None:
+        await on_complete("".join(parts))
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     body = await request.json()
     messages = body.get("messages", [])
     prompt = "\n".join([m["content"] for m in messages if m["role"] == "user"])
+    backend = router.get(body.get("model"))
+    if backend is None:
+        raise HTTPException(status_code=404, detail=f"Model not found: {body.get('model')}")
+    model = backend.name
+    temperature = body.get("temperature")
+    stream = body.get("stream", False)
+    stream_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    prompt_tokens = token_counter.count_messages(messages, backend.model)
+    client = token_counter.client_id(request, TRUST_CLIENT_ID_HEADER)
 
-    response = llm.invoke([HumanMessage(content=prompt)])
-    return {
-        "id": "chatcmpl-local",
-        "object": "chat.completion",
-        "choices": [{"message": {"role": "assistant", "content": response.content}}],
-    }
+    # キャッシュにあればLLMを呼ばずに返す（同時実行数の枠も消費しない）
+    cache_status = "disabled"
+    if response_cache is not None:
+        cache_status = "bypass"
+        if not cache_bypassed(request):
+            cached, cache_status = await response_cache.lookup(messages, model, temperature)
+            CACHE_LOOKUPS.inc(result=cache_status)
+            if cached is not None:
+                if stream:
+                    return StreamingResponse(
+                        stream_cached(cached, model),
+                        media_type="text/event-stream",
+                        headers={**stream_headers, "X-Cache": cache_status},
+                    )
+                return JSONResponse(
+                    {
+                        "id": "chatcmpl-local",
+                        "object": "chat.completion",
+                        "choices": [{"message": {"role": "assistant", "content": cached}}],
+                        "usage": token_counter.usage(prompt_tokens, token_counter.count_tokens(cached, backend.model)),
+                    },
+                    headers={"X-Cache": cache_status},
+                )
+
+    # キャッシュにない場合だけモデルの処理量としてレート制限の対象にする
+    if token_limiter is not None:
+        token_limiter.check(client, prompt_tokens)
+
+    async def store(content: str, completion_tokens: int = None):
+        if token_limiter is not None:
+            if completion_tokens is None:
+                completion_tokens = token_counter.count_tokens(content, backend.model)
+            token_limiter.consume(client, completion_tokens)
+        if response_cache is not None:
+            await response_cache.store(messages, model, temperature, content)
+
+    if stream:
+        await limiter.acquire()
+        replica = backend.acquire()
+        return StreamingResponse(
+            stream_completion(replica, [HumanMessage(content=prompt)], model, on_complete=store),
+            media_type="text/event-stream",
+            headers={**stream_headers, "X-Cache": cache_status},
+        )
+
+    if batcher is not None:
+        # 同時実行数の枠はリクエストごとではなく、送り出すバッチごとに MicroBatcher が確保する
+        with metrics.stage_timer("llm", model=model):
+            response = await batcher.submit(backend, [HumanMessage(content=prompt)])
+    else:
+        async with limiter.slot():
+            with metrics.stage_timer("llm", model=model):
+                replica = backend.acquire()
+                try:
+                    response = await replica.llm.ainvoke([HumanMessage(content=prompt)])
+                finally:
+                    replica.release()
+    completion_tokens = token_counter.count_tokens(response.content, backend.model)
+    await store(response.content, completion_tokens)
+    return JSONResponse(
+        {
+            "id": "chatcmpl-local",
+            "object": "chat.completion",
+            "choices": [{"message": {"role": "assistant", "content": response.content}}],
+            "usage": token_counter.usage(prompt_tokens, completion_tokens),
+        },
+        headers={"X-Cache": cache_status},
+    )
+
+@app.get("/v1/cache/stats")
+async def cache_stats():
+    if response_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **response_cache.stats()}
+
+@app.get("/v1/batch/stats")
+async def batch_stats():
+    if batcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **batcher.stats()}
 
 @app.get("/v1/models")
 async def list_models():
-    return {
-        "data": [
-            {"id": "nautilus-llm", "object": "model"},
-        ]
-    }
+    return {"object": "list", "data": router.list_models()}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,120 @@
+"""
+同時に届いた補完リクエストをまとめて abatch で処理するマイクロバッチャー
+
+最初のリクエストが届いてから max_wait 秒以内に届いた同じモデル宛てのリクエストを
+最大 max_batch_size 件まで1つのバッチにまとめ、llm.abatch に渡します。
+結果はそれぞれの呼び出し元へ返します。
+
+limiter（acquire / release を持つ同時実行数の制限）を渡すと、送り出すバッチごとに枠を1つ確保します。
+リクエストごとに枠を確保してからバッチを待つと、バッチの大きさが枠の数で頭打ちになり、
+待っている間も枠をふさいでしまうためです。枠を確保できなかった（429 / 503）ときはバッチ全体がその例外になります。
+"""
+
+import asyncio
+import time
+from typing import Dict
+
+import metrics
+
+BATCH_SIZE = metrics.REGISTRY.histogram(
+    "llm_batch_size", "Number of requests sent in one abatch call.", buckets=[1, 2, 4, 8, 16, 32, 64]
+)
+BATCH_WAIT = metrics.REGISTRY.histogram(
+    "llm_batch_wait_seconds", "Time a request waited in the micro-batch queue.",
+    buckets=[0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0],
+)
+
+
+class _Pending:
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """モデルバックエンドごとにリクエストを集約して abatch で実行する"""
+
+    def __init__(self, max_batch_size: int, max_wait: float, max_concurrency: int, limiter=None):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.limiter = limiter
+        self._pending: Dict[str, list] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._backends = {}
+        # 実行中のバッチのタスク（参照を持たないとGCで途中で消え、呼び出し元が待ち続ける）
+        self._tasks = set()
+
+    async def submit(self, backend, messages: list):
+        """バッチに追加し、結果（AIMessage）が返るまで待つ"""
+        item = _Pending(messages)
+        queue = self._pending.setdefault(backend.name, [])
+        self._backends[backend.name] = backend
+        queue.append(item)
+        if len(queue) >= self.max_batch_size:
+            self._flush(backend.name)
+        elif backend.name not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[backend.name] = loop.call_later(self.max_wait, self._flush, backend.name)
+        return await item.future
+
+    def _flush(self, name: str):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(name, [])
+        if batch:
+            task = asyncio.ensure_future(self._run(self._backends[name], batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, backend, batch: list):
+        if self.limiter is not None:
+            try:
+                await self.limiter.acquire()
+            except Exception as e:
+                self._resolve(batch, [e] * len(batch))
+                return
+        try:
+            # 待ち時間は同時実行数の枠の確保までを含める
+            now = time.perf_counter()
+            BATCH_SIZE.observe(len(batch), model=backend.name)
+            for item in batch:
+                BATCH_WAIT.observe(now - item.enqueued_at, model=backend.name)
+
+            replica = backend.acquire(weight=len(batch))
+            try:
+                results = await replica.llm.abatch(
+                    [item.messages for item in batch],
+                    config={"max_concurrency": self.max_concurrency},
+                    return_exceptions=True,
+                )
+            except Exception as e:
+                results = [e] * len(batch)
+            finally:
+                replica.release(weight=len(batch))
+        finally:
+            if self.limiter is not None:
+                self.limiter.release()
+        self._resolve(batch, results)
+
+    @staticmethod
+    def _resolve(batch: list, results: list):
+        for item, result in zip(batch, results):
+            if item.future.done():
+                continue
+            if isinstance(result, BaseException):
+                item.future.set_exception(result)
+            else:
+                item.future.set_result(result)
+
+    def stats(self) -> dict:
+        models = sorted(self._backends)
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait": self.max_wait,
+            "max_concurrency": self.max_concurrency,
+            "batch_size": {m: BATCH_SIZE.snapshot(model=m) for m in models},
+            "wait_time_seconds": {m: BATCH_WAIT.snapshot(model=m) for m in models},
+        }
@@ -0,0 +1,116 @@
+"""
+複数のLLMバックエンドを扱うモデルルーター
+
+models.json に定義したモデルごとに1つ以上のレプリカ（Ollamaホストなど）を持ち、
+リクエストの model フィールドでバックエンドを選択します。
+同じモデルのレプリカ間では、処理中リクエスト数が最も少ないものに振り分けます。
+各レプリカは専用の httpx.AsyncClient（コネクションプール）を持ちます。
+"""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+
+class Replica:
+    """1つの接続先（base_url）とその ChatOpenAI / HTTPコネクションプール"""
+
+    def __init__(self, model: str, base_url: str, api_key: str, pool: dict):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=pool.get("max_connections", 10),
+                max_keepalive_connections=pool.get("max_keepalive_connections", 5),
+                keepalive_expiry=pool.get("keepalive_expiry", 30),
+            ),
+            timeout=httpx.Timeout(pool.get("timeout", 120), connect=pool.get("connect_timeout", 5)),
+        )
+        self.llm = ChatOpenAI(
+            openai_api_base=base_url,
+            openai_api_key=api_key,
+            model=model,
+            http_async_client=self.client,
+        )
+
+    def release(self, weight: int = 1):
+        self.outstanding -= weight
+
+
+class ModelBackend:
+    """1つのモデルIDに対応するレプリカの集合"""
+
+    def __init__(self, name: str, model: str, replicas: List[Replica]):
+        self.name = name
+        self.model = model
+        self.replicas = replicas
+        self._next = 0
+
+    def acquire(self, weight: int = 1) -> Replica:
+        """処理中リクエスト数が最も少ないレプリカを選んで確保する（同数なら順番に回す）
+
+        weight にはまとめて送るリクエスト数を指定する（マイクロバッチ用）。
+        """
+        count = len(self.replicas)
+        order = [self.replicas[(self._next + i) % count] for i in range(count)]
+        replica = min(order, key=lambda r: r.outstanding)
+        self._next = (self.replicas.index(replica) + 1) % count
+        replica.outstanding += weight
+        return replica
+
+
+class ModelRouter:
+    """モデルIDからバックエンドを引くレジストリ"""
+
+    def __init__(self, backends: Dict[str, ModelBackend], default_model: Optional[str] = None):
+        self.backends = backends
+        self.default_model = default_model
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ModelRouter":
+        backends = {}
+        for name, cfg in config["models"].items():
+            model = cfg.get("model", name)
+            pool = cfg.get("pool", {})
+            replicas = [
+                Replica(model, r["base_url"], r.get("api_key", "none"), {**pool, **r.get("pool", {})})
+                for r in cfg["replicas"]
+            ]
+            backends[name] = ModelBackend(name, model, replicas)
+        return cls(backends, config.get("default_model"))
+
+    @classmethod
+    def from_file(cls, config_path: str) -> "ModelRouter":
+        with open(config_path, "r", encoding="utf-8") as f:
+            return cls.from_config(json.load(f))
+
+    @classmethod
+    def from_env(cls) -> "ModelRouter":
+        """models.json がない場合は環境変数の単一バックエンドで構成する"""
+        model = os.getenv("DEFAULT_MODEL", "qwen3:4b")
+        replica = {"base_url": os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1"),
+                   "api_key": os.getenv("OLLAMA_API_KEY", "none")}
+        return cls.from_config({
+            "default_model": model,
+            "models": {model: {"model": model, "replicas": [replica]}},
+        })
+
+    def get(self, name: Optional[str]) -> Optional[ModelBackend]:
+        """モデルIDに対応するバックエンドを返す。未指定ならデフォルト、未登録なら None"""
+        if not name:
+            name = self.default_model
+        return self.backends.get(name)
+
+    def list_models(self) -> List[dict]:
+        return [
+            {"id": name, "object": "model", "owned_by": "local", "replicas": len(b.replicas)}
+            for name, b in self.backends.items()
+        ]
+
+    async def aclose(self):
+        for backend in self.backends.values():
+            for replica in backend.replicas:
+                await replica.client.aclose()
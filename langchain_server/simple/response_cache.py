@@ -0,0 +1,263 @@
+"""
+OpenAI互換プロキシ用のレスポンスキャッシュ
+
+2段構成でLLMへの問い合わせを減らします：
+1. ExactCache    - 正規化したメッセージ列・モデル・temperature のハッシュをキーにしたメモリ上のLRU
+2. SemanticCache - embedding の類似度が閾値以上の過去の質問の回答を返す（SQLiteに保存、任意）
+
+どちらも TTL と件数上限による追い出し、ヒット/ミスのカウンタを持ちます。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize_messages(messages: List[dict]) -> List[Tuple[str, str]]:
+    """role と content だけを残し、空白の揺れを吸収したメッセージ列を返す"""
+    normalized = []
+    for m in messages:
+        content = m.get("content", "")
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, sort_keys=True)
+        normalized.append((m.get("role", "user"), " ".join(content.split())))
+    return normalized
+
+
+def cache_key(messages: List[dict], model: str, temperature) -> str:
+    """正規化したメッセージ列・モデル・temperature からキャッシュキーを作成"""
+    payload = json.dumps(
+        {"messages": normalize_messages(messages), "model": model, "temperature": temperature},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheStats:
+    """キャッシュのヒット/ミス等のカウンタ"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def to_dict(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class ExactCache:
+    """完全一致のメモリ上LRUキャッシュ"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        created, value = entry
+        if time.time() - created > self.ttl:
+            del self._entries[key]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def put(self, key: str, value: str):
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def to_dict(self) -> dict:
+        return {"entries": len(self._entries), "max_entries": self.max_entries, **self.stats.to_dict()}
+
+
+class SemanticCache:
+    """embedding の類似度で過去の回答を再利用するキャッシュ
+
+    ベクトルと回答はSQLiteに保存し、起動時にメモリへ読み込んで検索します。
+    partition（モデルとtemperature）が一致するエントリだけを比較対象にします。
+    """
+
+    def __init__(self, path: str, embeddings, max_entries: int, ttl: float, threshold: float):
+        self.path = path
+        self.embeddings = embeddings
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        # id -> (partition, 正規化済みベクトル, 回答, 作成時刻, 最終利用時刻)
+        self._entries = {}
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS semantic_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            partition TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+        """)
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM semantic_cache WHERE created_at < ?", (now - self.ttl,))
+            self._conn.commit()
+            rows = self._conn.execute(
+                "SELECT id, partition, embedding, response, created_at, last_used_at FROM semantic_cache"
+            ).fetchall()
+            for row_id, partition, blob, response, created, last_used in rows:
+                vec = np.frombuffer(blob, dtype=np.float32)
+                self._entries[row_id] = (partition, vec, response, created, last_used)
+
+    @staticmethod
+    def _normalize(vec) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _search(self, partition: str, vec: np.ndarray) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            expired = [i for i, e in self._entries.items() if now - e[3] > self.ttl]
+            for row_id in expired:
+                del self._entries[row_id]
+            if expired:
+                self._conn.executemany("DELETE FROM semantic_cache WHERE id = ?", [(i,) for i in expired])
+                self._conn.commit()
+                self.stats.expirations += len(expired)
+
+            candidates = [(i, e) for i, e in self._entries.items() if e[0] == partition and len(e[1]) == len(vec)]
+            if not candidates:
+                return None
+            matrix = np.stack([e[1] for _, e in candidates])
+            scores = matrix @ vec
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            row_id, (p, v, response, created, _) = candidates[best]
+            self._entries[row_id] = (p, v, response, created, now)
+            self._conn.execute("UPDATE semantic_cache SET last_used_at = ? WHERE id = ?", (now, row_id))
+            self._conn.commit()
+            return response
+
+    def _insert(self, partition: str, vec: np.ndarray, response: str):
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO semantic_cache (partition, embedding, response, created_at, last_used_at) VALUES (?,?,?,?,?)",
+                (partition, vec.tobytes(), response, now, now),
+            )
+            self._entries[cur.lastrowid] = (partition, vec, response, now, now)
+            # 件数上限を超えたら最終利用が古いものから削除
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                oldest = sorted(self._entries, key=lambda i: self._entries[i][4])[:overflow]
+                for row_id in oldest:
+                    del self._entries[row_id]
+                self._conn.executemany("DELETE FROM semantic_cache WHERE id = ?", [(i,) for i in oldest])
+                self.stats.evictions += len(oldest)
+            self._conn.commit()
+
+    async def get(self, partition: str, text: str) -> Optional[str]:
+        vec = self._normalize(await self.embeddings.aembed_query(text))
+        response = await asyncio.to_thread(self._search, partition, vec)
+        if response is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return response
+
+    async def put(self, partition: str, text: str, response: str):
+        vec = self._normalize(await self.embeddings.aembed_query(text))
+        await asyncio.to_thread(self._insert, partition, vec, response)
+
+    def to_dict(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            **self.stats.to_dict(),
+        }
+
+
+class ResponseCache:
+    """ExactCache と SemanticCache をまとめて扱う"""
+
+    def __init__(self, exact: ExactCache, semantic: Optional[SemanticCache] = None):
+        self.exact = exact
+        self.semantic = semantic
+
+    @staticmethod
+    def _partition(model: str, temperature) -> str:
+        return json.dumps([model, temperature])
+
+    @staticmethod
+    def _semantic_text(messages: List[dict]) -> str:
+        return "\n".join(f"{role}: {content}" for role, content in normalize_messages(messages))
+
+    async def lookup(self, messages: List[dict], model: str, temperature) -> Tuple[Optional[str], str]:
+        """キャッシュを検索し (回答, "exact"/"semantic"/"miss") を返す"""
+        value = self.exact.get(cache_key(messages, model, temperature))
+        if value is not None:
+            return value, "exact"
+        if self.semantic is not None:
+            try:
+                value = await self.semantic.get(self._partition(model, temperature), self._semantic_text(messages))
+            except Exception as e:
+                # embedding サーバーに繋がらない場合などはキャッシュなしで続行
+                print(f"[cache] semantic lookup failed: {e}")
+                value = None
+            if value is not None:
+                # 次回は完全一致で返せるように昇格させる
+                self.exact.put(cache_key(messages, model, temperature), value)
+                return value, "semantic"
+        return None, "miss"
+
+    async def store(self, messages: List[dict], model: str, temperature, response: str):
+        self.exact.put(cache_key(messages, model, temperature), response)
+        if self.semantic is not None:
+            try:
+                await self.semantic.put(self._partition(model, temperature), self._semantic_text(messages), response)
+            except Exception as e:
+                print(f"[cache] semantic store failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "exact": self.exact.to_dict(),
+            "semantic": self.semantic.to_dict() if self.semantic is not None else None,
+        }